@@ -2,20 +2,21 @@ import sys
 from logging import getLogger
 
 import sqlalchemy
-from telegram import Bot
 
-from app.run import get_user_day_timetable
-from misc.config import bot_token, db_connection_string
+from misc.db import get_engine
+from misc.outbox import SCHEDULED, enqueue_messages
+from misc.timetable import get_user_day_timetable
 
 logger = getLogger('send_daily')
-engine = sqlalchemy.create_engine(db_connection_string)
+engine = get_engine()
 try:
     user_id = int(sys.argv[1])
-    bot = Bot(bot_token)
     user_timetable = get_user_day_timetable(user_id)
     if user_timetable is not None or user_timetable == '':
-        # we can pass user_id as chat_id for private messages
-        bot.send_message(user_id, user_timetable)
+        # we can pass user_id as chat_id for private messages,
+        # the bot sends it, see enqueue_messages
+        with engine.begin() as conn:
+            enqueue_messages(conn, SCHEDULED, [(user_id, user_timetable, {})])
 except Exception as e:
     logger.error(e, exc_info=True)
 
@@ -1,51 +1,41 @@
-import locale
 import sys
 from logging import getLogger
 
 import sqlalchemy
-from telegram import Bot
 
-from misc.config import SQL_NOW, bot_token, db_connection_string
+from misc.config import SQL_NOW
+from misc.db import get_engine
+from misc.outbox import SCHEDULED, enqueue_messages
 
 logger = getLogger('send_news_daily')
-engine = sqlalchemy.create_engine(db_connection_string)
-
-locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
+engine = get_engine()
 
 
 def get_news_from_db():
-    news_text = ''
+    # display_html is rendered and sanitized by update_news.py
     with engine.begin() as conn:
         news_query = conn.execute(sqlalchemy.text(
-            'SELECT title, url, shorttext, news_date'
+            'SELECT display_html '
             'FROM test.news '
-            f'WHERE news_date > ({SQL_NOW} - INTERVAL \'1 DAY\')'
-            )
-        )
-
-        news_text = ''.join(map(
-            lambda row:
-                f"{row['title']}\n"
-                + (("[" + (row['shorttext']) + "]\n") if row['shorttext'] is not None else "")
-                + f"{row['url']}\n"
-                + f"{row['news_date'].strftime('%c')}\n\n",
-            news_query
+            f'WHERE news_date > ({SQL_NOW} - INTERVAL \'1 DAY\') '
+            'ORDER BY news_date DESC'
             )
         )
-    return news_text
+        return ''.join(row['display_html'] or '' for row in news_query)
 
 
 try:
     user_id = int(sys.argv[1])
-    bot = Bot(bot_token)
     news_text = get_news_from_db()
     if news_text is not None or news_text == '':
-        # we can pass user_id as chat_id for private messages
-        bot.send_message(user_id,
-                         news_text,
-                         parse_mode='HTML',
-                         disable_web_page_preview=True
-                         )
+        # we can pass user_id as chat_id for private messages,
+        # the bot sends it, see enqueue_messages
+        with engine.begin() as conn:
+            enqueue_messages(conn, SCHEDULED, [(
+                user_id,
+                news_text,
+                {'parse_mode': 'HTML', 'disable_web_page_preview': True}
+            )])
 except Exception as e:
     logger.error(e, exc_info=True)
 
@@ -2,17 +2,15 @@ from datetime import datetime
 from logging import getLogger
 
 import sqlalchemy
-from telegram import Bot
 
-import misc.config as config
-from app.run import create_at_job, get_offset_date
+from misc.at_jobs import create_at_job, get_offset_date
 from misc.constants import ENABLED_NEWS_NOTIFICATION
+from misc.db import get_engine
 
 logger = getLogger('make_tasks')
-engine = sqlalchemy.create_engine(config.db_connection_string)
+engine = get_engine()
 
 try:
-    bot = Bot(config.bot_token)
     users_to_add = engine.execute(
         sqlalchemy.text(
             "SELECT * FROM users.usergroup "
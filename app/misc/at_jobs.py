@@ -0,0 +1,60 @@
+import datetime
+import os
+import tempfile
+from logging import getLogger
+from subprocess import call
+
+import sqlalchemy
+
+import misc.constants as cns
+from misc.db import get_engine
+from misc.study_calendar import get_current_week
+from misc.timetable import get_timetable_source, get_user_group
+
+logger = getLogger(__name__)
+
+
+def switch_files(mode: str) -> str:
+    return 'send_schedule_daily.py' if mode == cns.ENABLED_SCHEDULE_NOTIFICATION else 'send_news_daily.py'
+
+
+def create_at_job(user_id: int, time: str, mode=cns.ENABLED_SCHEDULE_NOTIFICATION) -> str:
+    job_id = None
+    tmp = tempfile.NamedTemporaryFile(mode='r+t')
+    cmd = f'echo \"python3 {os.getcwd()}/{switch_files(mode)} {user_id}\" | at -m {time}'
+    call(cmd, shell=True, stderr=tmp)
+    tmp.seek(0)
+    for line in tmp:
+        if 'job' in line:
+            job_id = line.split()[1]
+    tmp.close()
+    return job_id
+
+
+def get_offset_date(user_id: int, input_time) -> str:
+    try:
+        current_study_week = get_current_week()
+        with get_engine().begin() as conn:
+            date_string = ''
+            user_group = get_user_group(user_id)
+            timetable, name_column, _ = get_timetable_source(user_group.is_teacher)
+            week_of_year = datetime.date.today().isocalendar()[1]
+            file = open('./misc/sql/select/next_first_pair.sql')
+            next_first_pair_query = conn.execute(sqlalchemy.text(
+                file.read().format(timetable=timetable, name_column=name_column)),
+                gn=user_group.name, week_num=current_study_week)
+            if next_first_pair_query.rowcount != 0:
+                tmp = next_first_pair_query.fetchone()
+                week_of_year = datetime.date.today().isocalendar()[1]
+                week = week_of_year - current_study_week + tmp['week']
+                first_pair_time = datetime.datetime.strptime(
+                    tmp['starttime'], '%H:%M')
+                notify_time = datetime.datetime.min + \
+                    (first_pair_time - input_time)
+                actual_date = datetime.datetime.fromisocalendar(datetime.date.today().isocalendar(
+                )[0], week, tmp['day']).replace(hour=notify_time.hour, minute=notify_time.minute)
+                date_string = actual_date.strftime('%H:%M %d.%m.%Y')
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        pass
+    return date_string
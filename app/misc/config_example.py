@@ -3,5 +3,24 @@ nstu_password = "***********"
 db_connection_string = "postgresql://*username*:*password*@*ip*:*port*/*db_name*"
 bot_token = "******************"
 SQL_NOW = "now() AT TIME ZONE \'Asia/Novosibirsk\'"
+# the same zone for the code, see get_local_now
+TIMEZONE = 'Asia/Novosibirsk'
 SERVER_IP_ADDRESS = '192.144.37.124'
 WEBHOOK_PORT = 8443
+ADMIN_IDS = []
+DELIVERY_RATE = 30
+DELIVERY_CHAT_INTERVAL = 1.0
+DELIVERY_WORKERS = 4
+TIMETABLE_SNAPSHOT_PATH = '/var/lib/nstu_student_bot/timetable.snapshot'
+# work class: (workers, queue size), see misc/pools.py
+WORKER_POOLS = {'db_read': (8, 200), 'db_write': (4, 100), 'telegram_io': (8, 400)}
+# handler class: (requests per second, burst) per user, see misc/rate_limit.py
+RATE_LIMITS = {'timetable': (0.5, 5), 'news': (0.5, 5), 'default': (2, 10)}
+LOG_FILE = './logs/bot.jsonl'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+# 'midnight' etc. to rotate by time instead of size
+LOG_ROTATE_WHEN = None
+# None disables stack sampling of slow handlers
+SLOW_HANDLER_THRESHOLD_MS = 1000
+PROFILE_DIR = './logs/profiles'
@@ -1,7 +1,13 @@
+import datetime
+
 USER_FREE_DAY = "Сегодня не учишься, угомонись"
 EMPTY_NEWS = 'На этот день у нас нет новостей'
+BOT_BUSY = 'Бот сейчас перегружен, попробуйте через минуту'
 CREDIT_WEEK = '18 (зачетная) неделя\nУточняйте расписание у преподавателей и в личном кабинете студента НГТУ'
-TIMETABLE_NAME = "test.tt_new"
+# partitioned by semester, see get_timetable_name
+TIMETABLE_NAME = "test.tt_history"
+TIMETABLE_WEEK_VIEW_NAME = "test.tt_group_week"
+TEACHER_TIMETABLE_WEEK_VIEW_NAME = "test.tt_teacher_week"
 NEWS_BUTTON_TEXT, NOTIFICATIONS_SETTINGS_BUTTON_TEXT, MAP_BUTTON_TEXT = 'Новости', 'Подписки', 'Карта НГТУ'
 SCHEDULE_BUTTON_TEXT, CHANGE_GROUP_BUTTON_TEXT = 'Расписание', 'Сменить группу'
 MENU_BUTTONS = [[SCHEDULE_BUTTON_TEXT, NEWS_BUTTON_TEXT], [MAP_BUTTON_TEXT, NOTIFICATIONS_SETTINGS_BUTTON_TEXT], [CHANGE_GROUP_BUTTON_TEXT]]
@@ -19,4 +25,54 @@ START_SETTINGS_HANDLER, SCHEDULE_SPECIFIC_TIME_SETTINGS_HANDLER, SETTINGS_CONTRO
 OFFSET_TIME_SETTINGS_HANDLER, CLAIM_USER_GROUP_HANDLER, SET_USER_GROUP_HANDLER, \
 SCHEDULE_MENU_HANDLER, SPECIFIC_WEEK_SCHEDULE_HANDLER, NEWS_MENU_HANDLER, \
 SPECIFIC_DATE_NEWS_HANDLER, NEWS_SPECIFIC_TIME_SETTINGS_HANDLER = range(5000, 5011)
-
+EDITED_MESSAGES_CACHE_SIZE = 10000
+MAX_MESSAGE_LENGTH = 4096
+USER_GROUP_CACHE_SIZE = 50000
+TEACHER_CALLBACK_PREFIX = 'TEACHER:'
+TEACHER_NAMES_TTL = 24 * 3600
+TEACHER_SEARCH_LIMIT = 3
+NEWS_SEARCH_PAGE_PREFIX = 'NEWS_SEARCH_PAGE:'
+NEWS_SEARCH_PAGE_SIZE = 5
+NEWS_SEARCH_BUDGET_MS = 200
+NEWS_SEARCH_TIMEOUT_MS = 2000
+# news_cache key of get_news_page pages
+NEWS_PAGE = 'NEWS_PAGE'
+NEWS_PAGE_SIZE = 5
+OLDER_NEWS_PREFIX = 'OLDER_NEWS:'
+ROOM_OCCUPANCY_TTL = 24 * 3600
+DB_CONNECT_TIMEOUT = 3
+TIMETABLE_DB_TIMEOUT_MS = 1500
+TIMETABLE_DB_LATENCY_THRESHOLD_MS = 500
+DB_DEGRADED_SECONDS = 30
+UPDATE_DEDUP_WINDOW = 10000
+RATE_LIMIT_USERS = 10000
+THROTTLED = 'Слишком часто, подождите немного'
+LOG_ERROR_BURST = 5
+LOG_ERROR_INTERVAL = 60
+LOG_RATE_LIMIT_KEYS = 1000
+SLOW_HANDLER_CHECK_INTERVAL = 0.1
+PROFILER_SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+NEWS_CACHE_SIZE = 64
+NEWS_CACHE_TTL = 24 * 3600
+NOTIFY_POLL_TIMEOUT = 60
+NOTIFY_RECONNECT_DELAY = 5
+TIMETABLE_CHANGED = 'Изменилось расписание:\n'
+NO_PAIRS = 'Пар нет\n'
+PRERENDERED_CACHE_SIZE = 20000
+PRERENDERED_CACHE_TTL = 24 * 3600
+PAIR_INDEX_CACHE_SIZE = 5000
+PAIR_INDEX_TTL = 24 * 3600
+NO_CURRENT_PAIR = 'Сейчас пары нет'
+NO_NEXT_PAIR = 'Пар в этом семестре больше не будет'
+# see misc/prewarm.py, lead and window in seconds
+PREWARM_PLAN_TIME = datetime.time(5, 0)
+PREWARM_LEAD = 10 * 60
+PREWARM_PEAK_WINDOW = 20 * 60
+PREWARM_CONNECTIONS = 5
+NEWS_API_URL = 'https://api.ciu.nstu.ru/v1.0/news/schoolkids/'
+NEWS_BACKFILL_WORKERS = 8
+NEWS_BACKFILL_BATCH_DAYS = 30
+NEWS_BACKFILL_REQUEST_TIMEOUT = 30
+WEEKDAY_NAMES = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
+NO_HISTORY = 'Расписания за прошлый семестр нет'
@@ -0,0 +1,21 @@
+import threading
+
+import sqlalchemy
+
+import misc.config as config
+import misc.constants as cns
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> sqlalchemy.engine.Engine:
+    """Engine shared by the whole process, created on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = sqlalchemy.create_engine(
+                config.db_connection_string,
+                connect_args={'connect_timeout': cns.DB_CONNECT_TIMEOUT}
+            )
+        return _engine
@@ -0,0 +1,49 @@
+import threading
+from array import array
+
+
+class RecentIds:
+    """Window of the last `size` ids: a ring buffer for eviction order
+    and a set for lookups. Safe to share between handler threads."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ring = array('q', [0] * size)
+        self._ids = set()
+        # ids the bot put back to the queue itself, see mark_requeued
+        self._requeued = set()
+        self._next = 0
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def check_and_add(self, id_: int) -> bool:
+        """True if id_ was already in the window, otherwise remembers it."""
+        with self._lock:
+            if id_ in self._requeued:
+                return False
+            if id_ in self._ids:
+                self.duplicates += 1
+                return True
+            if len(self._ids) == self.size:
+                self._ids.discard(self._ring[self._next])
+            self._ring[self._next] = id_
+            self._ids.add(id_)
+            self._next = (self._next + 1) % self.size
+            return False
+
+    def mark_requeued(self, id_: int) -> None:
+        """Lets id_ through check_and_add until take_requeued is called for it."""
+        with self._lock:
+            self._requeued.add(id_)
+
+    def take_requeued(self, id_: int) -> bool:
+        """True if id_ was marked with mark_requeued, the mark is removed."""
+        with self._lock:
+            if id_ not in self._requeued:
+                return False
+            self._requeued.discard(id_)
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'window': len(self._ids), 'duplicates': self.duplicates}
@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+from logging import getLogger
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+import misc.config as config
+import misc.metrics as metrics
+from misc.outbox import BULK, INTERACTIVE, SCHEDULED
+
+logger = getLogger(__name__)
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', SCHEDULED: 'scheduled', BULK: 'bulk'}
+
+# Telegram allows about 30 messages per second overall
+# and about one message per second in a single chat.
+# INTERACTIVE jobs answer the user's own taps and skip the chat pacing.
+DEFAULT_RATE = 30
+DEFAULT_CHAT_INTERVAL = 1.0
+DEFAULT_WORKERS = 4
+CHAT_PACING_DICT_SIZE = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(delay)
+
+
+class _Job:
+    __slots__ = ('priority', 'chat_id', 'func', 'args', 'kwargs', 'future', 'created')
+
+    def __init__(self, priority, chat_id, func, args, kwargs):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.created = time.monotonic()
+
+
+class DeliveryQueue:
+    def __init__(self, rate: float = DEFAULT_RATE,
+                 chat_interval: float = DEFAULT_CHAT_INTERVAL,
+                 workers: int = DEFAULT_WORKERS):
+        self.chat_interval = chat_interval
+        self._bucket = TokenBucket(rate, rate)
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        # (priority, seq, job) ready to go
+        self._ready = []
+        # (ready_at, priority, seq, job) waiting for chat pacing or RetryAfter
+        self._delayed = []
+        self._chat_next_time = {}
+        self._depth = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._sent = dict.fromkeys(PRIORITY_NAMES, 0)
+        self._wait_total = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        self._wait_max = dict.fromkeys(PRIORITY_NAMES, 0.0)
+        for i in range(workers):
+            threading.Thread(
+                target=self._worker, name=f'delivery_{i}', daemon=True).start()
+
+    def submit(self, priority: int, chat_id, func, *args, **kwargs) -> Future:
+        job = _Job(priority, chat_id, func, args, kwargs)
+        with self._cond:
+            heapq.heappush(self._ready, (priority, next(self._seq), job))
+            self._depth[priority] += 1
+            self._cond.notify()
+        return job.future
+
+    def stats(self) -> dict:
+        with self._cond:
+            result = {}
+            for priority, name in PRIORITY_NAMES.items():
+                sent = self._sent[priority]
+                result[f'{name}_depth'] = self._depth[priority]
+                result[f'{name}_sent'] = sent
+                result[f'{name}_wait_avg'] = round(
+                    self._wait_total[priority] / sent, 3) if sent else 0
+                result[f'{name}_wait_max'] = round(self._wait_max[priority], 3)
+            return result
+
+    def _next_job(self) -> _Job:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, priority, seq, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (priority, seq, job))
+                if self._ready:
+                    priority, seq, job = heapq.heappop(self._ready)
+                    chat_ready_at = self._chat_next_time.get(job.chat_id, 0)
+                    if job.priority != INTERACTIVE and chat_ready_at > now:
+                        heapq.heappush(self._delayed, (chat_ready_at, priority, seq, job))
+                        continue
+                    self._reserve_chat(job.chat_id, now)
+                    return job
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _reserve_chat(self, chat_id, now: float) -> None:
+        if chat_id is None:
+            return
+        self._chat_next_time[chat_id] = now + self.chat_interval
+        if len(self._chat_next_time) > CHAT_PACING_DICT_SIZE:
+            self._chat_next_time = {
+                chat: ready_at
+                for chat, ready_at in self._chat_next_time.items()
+                if ready_at > now
+            }
+
+    def _worker(self) -> None:
+        while True:
+            job = self._next_job()
+            self._bucket.acquire()
+            waited = time.monotonic() - job.created
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except RetryAfter as e:
+                metrics.inc('delivery_retry_after')
+                logger.warning(f'RetryAfter {e.retry_after}s for chat {job.chat_id}')
+                self._bucket.pause(e.retry_after)
+                with self._cond:
+                    heapq.heappush(
+                        self._delayed,
+                        (time.monotonic() + e.retry_after, job.priority, next(self._seq), job)
+                    )
+                    self._cond.notify()
+                continue
+            except Exception as e:
+                self._done(job, waited)
+                job.future.set_exception(e)
+                continue
+            self._done(job, waited)
+            job.future.set_result(result)
+
+    def _done(self, job: _Job, waited: float) -> None:
+        with self._cond:
+            self._depth[job.priority] -= 1
+            self._sent[job.priority] += 1
+            self._wait_total[job.priority] += waited
+            self._wait_max[job.priority] = max(self._wait_max[job.priority], waited)
+
+
+_delivery_queue = None
+_delivery_queue_lock = threading.Lock()
+
+
+def get_delivery_queue() -> DeliveryQueue:
+    global _delivery_queue
+    with _delivery_queue_lock:
+        if _delivery_queue is None:
+            _delivery_queue = DeliveryQueue(
+                rate=config.DELIVERY_RATE,
+                chat_interval=config.DELIVERY_CHAT_INTERVAL,
+                workers=config.DELIVERY_WORKERS
+            )
+            metrics.register_stats_source('delivery', _delivery_queue.stats)
+        return _delivery_queue
+
+
+class DeliveryBot(Bot):
+    """Bot whose outgoing messages go through the shared delivery queue."""
+
+    def __init__(self, *args, priority: int = INTERACTIVE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._delivery_priority = priority
+
+    def queue_message(self, chat_id, text: str, priority: int = None, **kwargs) -> Future:
+        return get_delivery_queue().submit(
+            self._delivery_priority if priority is None else priority, chat_id,
+            super().send_message, chat_id, text, **kwargs)
+
+    def _queued(self, method, chat_id, *args, **kwargs):
+        return get_delivery_queue().submit(
+            self._delivery_priority, chat_id, method, *args, **kwargs).result()
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._queued(super().send_message, chat_id, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self._queued(super().send_photo, chat_id, chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self._queued(super().send_document, chat_id, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._queued(
+            super().edit_message_text, kwargs.get('chat_id'), *args, **kwargs)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self._queued(
+            super().edit_message_reply_markup, kwargs.get('chat_id'), *args, **kwargs)
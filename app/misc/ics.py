@@ -0,0 +1,90 @@
+import datetime
+import hashlib
+
+ICS_TIMEZONE = 'Asia/Novosibirsk'
+
+ICS_HEADER = (
+    'BEGIN:VCALENDAR',
+    'VERSION:2.0',
+    'PRODID:-//nstu_student_bot//timetable//RU',
+    'CALSCALE:GREGORIAN',
+    'METHOD:PUBLISH',
+    f'X-WR-TIMEZONE:{ICS_TIMEZONE}',
+)
+
+ICS_VTIMEZONE = (
+    'BEGIN:VTIMEZONE',
+    f'TZID:{ICS_TIMEZONE}',
+    'BEGIN:STANDARD',
+    'DTSTART:19700101T000000',
+    'TZOFFSETFROM:+0700',
+    'TZOFFSETTO:+0700',
+    'TZNAME:+07',
+    'END:STANDARD',
+    'END:VTIMEZONE',
+)
+
+
+def escape_ics_text(text) -> str:
+    return str(text).replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold_ics_line(line: str) -> str:
+    # Lines longer than 75 octets are folded with CRLF + space
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        cut = min(len(encoded), 75 if not parts else 74)
+        # don't cut a utf-8 character in half
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode())
+        encoded = encoded[cut:]
+    return '\r\n '.join(parts)
+
+
+def get_pair_date(first_study_day: datetime.date, week: int, day: int) -> datetime.date:
+    first_monday = first_study_day - datetime.timedelta(days=first_study_day.weekday())
+    return first_monday + datetime.timedelta(weeks=week - 1, days=day - 1)
+
+
+def format_ics_datetime(date: datetime.date, time_str: str) -> str:
+    hours, minutes = time_str.split(':')
+    return f"{date.strftime('%Y%m%d')}T{int(hours):02d}{int(minutes):02d}00"
+
+
+def build_group_calendar(group_name: str, rows, first_study_day: datetime.date) -> str:
+    """rows of one group from the timetable view, one row per (pair, week)"""
+    # DTSTAMP must not change between runs, otherwise content hash does too
+    dtstamp = first_study_day.strftime('%Y%m%dT000000Z')
+    lines = list(ICS_HEADER)
+    lines.append(f'X-WR-CALNAME:{escape_ics_text(group_name)}')
+    lines.extend(ICS_VTIMEZONE)
+    for row in rows:
+        date = get_pair_date(first_study_day, row['week'], row['day'])
+        summary = row['classname'] if row['tsw_name'] is None \
+            else f"{row['classname']} [{row['tsw_name']}]"
+        teachers = ' '.join(
+            teacher for teacher in (row['teacher1'], row['teacher2']) if teacher)
+        lines.extend((
+            'BEGIN:VEVENT',
+            f"UID:{row['pk']}-{row['week']}@nstu_student_bot",
+            f'DTSTAMP:{dtstamp}',
+            f"DTSTART;TZID={ICS_TIMEZONE}:{format_ics_datetime(date, row['starttime'])}",
+            f"DTEND;TZID={ICS_TIMEZONE}:{format_ics_datetime(date, row['endtime'])}",
+            f'SUMMARY:{escape_ics_text(summary)}',
+        ))
+        if row['rooms']:
+            lines.append(f"LOCATION:{escape_ics_text(row['rooms'])}")
+        if teachers:
+            lines.append(f'DESCRIPTION:{escape_ics_text(teachers)}')
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(map(fold_ics_line, lines)) + '\r\n'
+
+
+def get_content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
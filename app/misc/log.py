@@ -0,0 +1,174 @@
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+import misc.config as config
+import misc.constants as cns
+import misc.metrics as metrics
+import misc.pools as pools
+import misc.profiling as profiling
+
+# (update_id, user_id, handler name) of the update being handled,
+# copied into worker pool threads together with the rest of the context
+handler_context = contextvars.ContextVar('handler_context', default=(None, None, None))
+
+handler_logger = logging.getLogger('handlers')
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.update_id, record.user_id, record.handler = handler_context.get()
+        return True
+
+
+class ErrorRateLimitFilter(logging.Filter):
+    """Lets through `burst` errors per call site and exception type every `interval`
+    seconds. The next record that passes carries the number of dropped ones."""
+
+    def __init__(self, burst: int, interval: float):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # key -> [window start, records in window, suppressed]
+        self._windows = {}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.ERROR:
+            return True
+        exc_type = record.exc_info[0].__name__ if record.exc_info else None
+        key = (record.name, record.lineno, exc_type)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if len(self._windows) > cns.LOG_RATE_LIMIT_KEYS:
+                    self._windows.clear()
+                suppressed = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.burst:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+            return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in ('update_id', 'user_id', 'handler', 'duration_ms', 'suppressed'):
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare formats the record, traceback included, on the
+    # calling thread. Leave that to the listener thread.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def get_file_handler() -> logging.Handler:
+    if config.LOG_ROTATE_WHEN is not None:
+        return logging.handlers.TimedRotatingFileHandler(
+            config.LOG_FILE,
+            when=config.LOG_ROTATE_WHEN,
+            backupCount=config.LOG_BACKUP_COUNT,
+            encoding='utf-8'
+        )
+    return logging.handlers.RotatingFileHandler(
+        config.LOG_FILE,
+        maxBytes=config.LOG_MAX_BYTES,
+        backupCount=config.LOG_BACKUP_COUNT,
+        encoding='utf-8'
+    )
+
+
+def setup_logging(level: int = logging.WARNING) -> None:
+    """Route all records through a queue to a listener thread that writes JSON lines."""
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    rate_limit_filter = ErrorRateLimitFilter(cns.LOG_ERROR_BURST, cns.LOG_ERROR_INTERVAL)
+    queue_handler.addFilter(rate_limit_filter)
+
+    file_handler = get_file_handler()
+    file_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+    # one record per handled update
+    handler_logger.setLevel(logging.INFO)
+
+    metrics.register_stats_source('logging', lambda: {
+        'queued': log_queue.qsize(),
+        'suppressed_errors': rate_limit_filter.suppressed
+    })
+
+
+def instrument(callback):
+    """Wraps a handler callback to set the logging context and log its duration."""
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        user = getattr(update, 'effective_user', None)
+        token = handler_context.set((
+            getattr(update, 'update_id', None),
+            user.id if user is not None else None,
+            callback.__name__
+        ))
+        update_token = pools.current_update.set(update)
+        watchdog = profiling.slow_handler_watchdog
+        if watchdog is not None:
+            watchdog.begin(callback.__name__)
+        start_time = time.monotonic()
+        try:
+            return callback(update, context)
+        finally:
+            handler_logger.info(
+                'handled', extra={'duration_ms': round((time.monotonic() - start_time) * 1000, 1)})
+            if watchdog is not None:
+                watchdog.end()
+            pools.current_update.reset(update_token)
+            handler_context.reset(token)
+    return wrapper
+
+
+def instrument_handlers(handlers) -> None:
+    """Instruments callbacks of the handlers, descending into conversations."""
+    for handler in handlers:
+        if hasattr(handler, 'entry_points'):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        elif not getattr(handler.callback, '__wrapped__', None):
+            handler.callback = instrument(handler.callback)
@@ -0,0 +1,39 @@
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+
+counters = Counter()
+
+# name -> function returning dict of values, used for /stats
+_stats_sources = {}
+
+
+def inc(name: str, value: int = 1) -> None:
+    with _lock:
+        counters[name] += value
+
+
+def register_stats_source(name: str, func) -> None:
+    _stats_sources[name] = func
+
+
+def snapshot() -> dict:
+    with _lock:
+        result = {'counters': dict(counters)}
+    for name, func in _stats_sources.items():
+        try:
+            result[name] = func()
+        except Exception as e:
+            result[name] = {'error': str(e)}
+    return result
+
+
+def format_stats() -> str:
+    lines = []
+    for section, values in snapshot().items():
+        lines.append(f'[{section}]')
+        for key in sorted(values):
+            lines.append(f'{key}: {values[key]}')
+        lines.append('')
+    return '\n'.join(lines)
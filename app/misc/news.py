@@ -0,0 +1,180 @@
+import datetime
+import re
+import time
+from html import escape, unescape
+from logging import getLogger
+
+import sqlalchemy
+
+import misc.constants as cns
+import misc.metrics as metrics
+from misc.cache import LRUCache
+from misc.db import get_engine
+from misc.study_calendar import set_ru_locale
+
+logger = getLogger(__name__)
+
+# (news interval, date) -> rendered news, dropped when update_news.py inserts news
+news_cache = LRUCache('news', cns.NEWS_CACHE_SIZE, ttl=cns.NEWS_CACHE_TTL)
+
+
+HTML_TAG_RE = re.compile(r'<[^>]*>')
+
+
+def NEWS_ROW_TEMPLATE(row) -> str:
+    # Rendered once at ingestion into test.news.display_html, see fill_news_display_html
+    return (
+        f"{sanitize_news_text(row['title'])}\n"
+        + (('[' + sanitize_news_text(row['shorttext']) + ']\n')
+           if row['shorttext'] is not None
+           else '')
+        + escape(row['url'] or '') + '\n'
+        + (row['news_date'].strftime('%c') if row['news_date'] is not None else '')
+        + '\n\n'
+    )
+
+
+def sanitize_news_text(data: str) -> str:
+    # Source text is escaped html with <img/>, <br /> and such inside.
+    # Keep plain text, escaped for telegram parse_mode='HTML'
+    return escape(HTML_TAG_RE.sub('', unescape(data or '')), quote=False)
+
+
+def get_news_from_db(news_interval: str, date: datetime.date = None) -> str:
+    # DAY_NEWS changes with the day, so it is cached per day too
+    if news_interval == cns.DAY_NEWS:
+        date = datetime.date.today()
+    return news_cache.get_or_load((news_interval, date), load_news_from_db)
+
+
+def load_news_from_db(key) -> str:
+    news_interval, date = key
+    params = {}
+    where_sql = ''
+    if news_interval in (cns.DAY_NEWS, cns.SPECIFIC_DATE_NEWS):
+        # half-open range, so that the news_date index is used
+        where_sql = 'WHERE news_date >= :day_start AND news_date < :day_end '
+        params['day_start'] = datetime.datetime.combine(date, datetime.time())
+        params['day_end'] = params['day_start'] + datetime.timedelta(days=1)
+    limit_sql = ''
+    if isinstance(news_interval, int):
+        limit_sql = 'LIMIT :lim'
+        params['lim'] = news_interval
+    with get_engine().begin() as conn:
+        news_query = conn.execute(
+            sqlalchemy.text(
+                'SELECT display_html '
+                'FROM test.news '
+                f'{where_sql}'
+                'ORDER BY news_date DESC, id DESC '
+                f'{limit_sql}'
+            ),
+            **params
+        )
+        return ''.join(row['display_html'] or '' for row in news_query)
+
+
+NEWS_KEY_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode_news_key(news_key) -> str:
+    # (news_date, id) -> 'microseconds since epoch:id', fits in callback data
+    news_date, news_id = news_key
+    return f'{(news_date - NEWS_KEY_EPOCH) // datetime.timedelta(microseconds=1)}:{news_id}'
+
+
+def decode_news_key(data: str):
+    microseconds, news_id = data.split(':')
+    return NEWS_KEY_EPOCH + datetime.timedelta(microseconds=int(microseconds)), int(news_id)
+
+
+def get_news_page(before=None):
+    """(text, key of its last news or None if there are no older ones) of the
+    cns.NEWS_PAGE_SIZE news older than before=(news_date, id), the latest by default"""
+    return news_cache.get_or_load((cns.NEWS_PAGE, before), load_news_page)
+
+
+def load_news_page(key):
+    _, before = key
+    params = {'lim': cns.NEWS_PAGE_SIZE + 1}
+    before_sql = ''
+    if before is not None:
+        before_sql = 'AND (news_date, id) < (:before_date, :before_id) '
+        params['before_date'], params['before_id'] = before
+    with get_engine().begin() as conn:
+        # keyset pagination: a range scan of news_date_idx however deep the page is
+        rows = conn.execute(
+            sqlalchemy.text(
+                'SELECT id, news_date, display_html '
+                'FROM test.news '
+                'WHERE news_date IS NOT NULL '
+                f'{before_sql}'
+                'ORDER BY news_date DESC, id DESC '
+                'LIMIT :lim'
+            ),
+            **params
+        ).fetchall()
+    page_rows = rows[:cns.NEWS_PAGE_SIZE]
+    last_key = (page_rows[-1]['news_date'], page_rows[-1]['id']) \
+        if len(rows) > cns.NEWS_PAGE_SIZE else None
+    return ''.join(row['display_html'] or '' for row in page_rows), last_key
+
+
+def search_news_in_db(search_query: str, page: int):
+    # Returns (text, has_next_page), text is None if search took too long
+    start_time = time.monotonic()
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(sqlalchemy.text(
+                f'SET LOCAL statement_timeout = {cns.NEWS_SEARCH_TIMEOUT_MS}'))
+            rows = conn.execute(sqlalchemy.text(
+                "SELECT display_html "
+                "FROM test.news, plainto_tsquery('russian', :q) AS query "
+                "WHERE search_vector @@ query "
+                "ORDER BY ts_rank_cd(search_vector, query) DESC, news_date DESC "
+                "LIMIT :lim OFFSET :off"),
+                q=search_query,
+                lim=cns.NEWS_SEARCH_PAGE_SIZE + 1,
+                off=page * cns.NEWS_SEARCH_PAGE_SIZE
+            ).fetchall()
+    except sqlalchemy.exc.OperationalError as e:
+        metrics.inc('news_search_timeout')
+        logger.warning(f'news search "{search_query}" failed: {e}')
+        return None, False
+    finally:
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        if elapsed_ms > cns.NEWS_SEARCH_BUDGET_MS:
+            metrics.inc('news_search_over_budget')
+            logger.warning(f'news search "{search_query}" took {elapsed_ms:.0f} ms')
+    return (
+        ''.join(row['display_html'] or '' for row in rows[:cns.NEWS_SEARCH_PAGE_SIZE]),
+        len(rows) > cns.NEWS_SEARCH_PAGE_SIZE
+    )
+
+
+def fill_news_search_vectors(conn):
+    # Title words rank higher than shorttext words in /search
+    conn.execute(sqlalchemy.text(
+        '''
+        UPDATE test.news
+        SET search_vector =
+            setweight(to_tsvector('russian', coalesce(title, '')), 'A')
+            || setweight(to_tsvector('russian', coalesce(shorttext, '')), 'B')
+        WHERE search_vector IS NULL
+        '''
+        )
+    )
+
+
+def fill_news_display_html(conn):
+    # Readers send display_html as is, nothing is rendered per request
+    set_ru_locale()
+    rows = conn.execute(sqlalchemy.text(
+        'SELECT id, title, url, shorttext, news_date '
+        'FROM test.news WHERE display_html IS NULL'
+    )).fetchall()
+    if rows:
+        conn.execute(
+            sqlalchemy.text('UPDATE test.news SET display_html = :html WHERE id = :id'),
+            [{'id': row['id'], 'html': NEWS_ROW_TEMPLATE(row)} for row in rows]
+        )
@@ -0,0 +1,102 @@
+import select
+import threading
+import time
+import uuid
+from logging import getLogger
+
+import sqlalchemy
+
+import misc.config as config
+import misc.constants as cns
+import misc.metrics as metrics
+
+logger = getLogger(__name__)
+
+# Channels, payload in brackets
+TIMETABLE_RELOADED = 'timetable_reloaded'   # empty
+NEWS_INSERTED = 'news_inserted'             # number of inserted news
+USER_CHANGED = 'user_changed'               # user_id
+DELIVERY_QUEUED = 'delivery_queued'         # number of queued messages
+
+# Sent as 'origin payload', so that a process can tell its own events
+ORIGIN = uuid.uuid4().hex[:12]
+
+
+def notify(conn, channel: str, payload='') -> None:
+    # Delivered when the transaction of conn commits, and only if it does
+    conn.execute(
+        sqlalchemy.text('SELECT pg_notify(:channel, :payload)'),
+        channel=channel,
+        payload=f'{ORIGIN} {payload}'
+    )
+
+
+class NotifyListener:
+    """Calls handlers[channel](payload) for every NOTIFY on the channels.
+
+    After a reconnect handlers get payload None: events sent while we were
+    disconnected are lost, so everything they cover must be invalidated.
+
+    Events sent by this process are skipped, it has applied them already,
+    e.g. user_group_cache is written through before USER_CHANGED."""
+
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name='notify_listener', daemon=True).start()
+
+    def _run(self) -> None:
+        connected_before = False
+        while True:
+            try:
+                conn = self._connect()
+                if connected_before:
+                    self._dispatch_all(None)
+                connected_before = True
+                self._listen(conn)
+            except Exception as e:
+                metrics.inc('notify_listener_errors')
+                logger.error(f'notify listener: {e}', exc_info=True)
+                time.sleep(cns.NOTIFY_RECONNECT_DELAY)
+
+    def _connect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        conn = psycopg2.connect(config.db_connection_string)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            for channel in self.handlers:
+                cursor.execute(f'LISTEN {channel}')
+        return conn
+
+    def _listen(self, conn) -> None:
+        try:
+            while True:
+                # the timeout only bounds how long a dead connection goes unnoticed
+                if select.select([conn], [], [], cns.NOTIFY_POLL_TIMEOUT) == ([], [], []):
+                    with conn.cursor() as cursor:
+                        cursor.execute('SELECT 1')
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    origin, _, payload = notification.payload.partition(' ')
+                    if origin == ORIGIN:
+                        metrics.inc('notify_own_skipped')
+                        continue
+                    self._dispatch(notification.channel, payload)
+        finally:
+            conn.close()
+
+    def _dispatch(self, channel: str, payload) -> None:
+        metrics.inc(f'notify_{channel}')
+        try:
+            self.handlers[channel](payload)
+        except Exception as e:
+            logger.error(f'{channel} handler: {e}', exc_info=True)
+
+    def _dispatch_all(self, payload) -> None:
+        for channel in self.handlers:
+            self._dispatch(channel, payload)
@@ -0,0 +1,104 @@
+import datetime
+import json
+import threading
+from concurrent.futures import Future
+from logging import getLogger
+
+import sqlalchemy
+
+import misc.metrics as metrics
+from misc.db import get_engine
+from misc.notify import DELIVERY_QUEUED, notify
+
+logger = getLogger(__name__)
+
+# Delivery priorities, lower value is sent first, see misc/delivery.py
+INTERACTIVE, SCHEDULED, BULK = 0, 1, 2
+
+OUTBOX_BATCH_SIZE = 500
+
+# Only the bot process talks to telegram, so that one delivery queue and one
+# rate budget cover everything we send. Other processes (daily senders,
+# update scripts) put their messages into test.delivery_outbox instead,
+# this module does not import telegram to keep their start cheap.
+def enqueue_messages(conn, priority: int, messages) -> int:
+    """Queues [(chat_id, text, send_message kwargs), ...] for the bot,
+    they are sent after the transaction of conn commits."""
+    messages = [
+        {
+            'priority': priority,
+            'chat_id': chat_id,
+            'text': text,
+            'options': json.dumps(options)
+        }
+        for chat_id, text, options in messages
+    ]
+    if not messages:
+        return 0
+    conn.execute(
+        sqlalchemy.text(
+            'INSERT INTO test.delivery_outbox (priority, chat_id, text, options) '
+            'VALUES (:priority, :chat_id, :text, CAST(:options AS jsonb))'
+        ),
+        messages
+    )
+    notify(conn, DELIVERY_QUEUED, len(messages))
+    return len(messages)
+
+
+_outbox_lock = threading.Lock()
+
+# Rows claimed before this start were queued by a bot process that is gone
+_started_at = datetime.datetime.now()
+
+
+def drain_outbox(bot) -> int:
+    """Moves queued messages from test.delivery_outbox to the delivery queue
+    of bot, a misc.delivery.DeliveryBot.
+    Called by the bot on DELIVERY_QUEUED and at start. Returns number of messages.
+
+    A row is only claimed here and deleted once its message is sent, so
+    messages the bot held in memory when it stopped are sent after restart."""
+    drained = 0
+    with _outbox_lock:
+        while True:
+            with get_engine().begin() as conn:
+                rows = conn.execute(
+                    sqlalchemy.text(
+                        'UPDATE test.delivery_outbox SET claimed_at = :now '
+                        'WHERE id IN ('
+                        '    SELECT id FROM test.delivery_outbox '
+                        '    WHERE claimed_at IS NULL OR claimed_at < :started_at '
+                        '    ORDER BY priority, id LIMIT :lim FOR UPDATE SKIP LOCKED'
+                        ') RETURNING id, priority, chat_id, text, options'
+                    ),
+                    now=datetime.datetime.now(),
+                    started_at=_started_at,
+                    lim=OUTBOX_BATCH_SIZE
+                ).fetchall()
+            for row in sorted(rows, key=lambda row: row['id']):
+                future = bot.queue_message(
+                    row['chat_id'], row['text'], priority=row['priority'], **row['options'])
+                future.add_done_callback(_finish_outbox_message(row['id'], row['chat_id']))
+            drained += len(rows)
+            if len(rows) < OUTBOX_BATCH_SIZE:
+                return drained
+
+
+def _finish_outbox_message(outbox_id: int, chat_id):
+    def callback(future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            # RetryAfter is retried by the delivery queue, the rest would fail again
+            metrics.inc('delivery_outbox_failed')
+            logger.error(f'queued message for {chat_id}: {error}')
+        try:
+            with get_engine().begin() as conn:
+                conn.execute(
+                    sqlalchemy.text('DELETE FROM test.delivery_outbox WHERE id = :id'),
+                    id=outbox_id
+                )
+        except Exception as e:
+            # the row is sent again after a restart
+            logger.error(f'outbox row {outbox_id}: {e}', exc_info=True)
+    return callback
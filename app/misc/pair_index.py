@@ -0,0 +1,77 @@
+from bisect import bisect_right
+
+import sqlalchemy
+
+import misc.constants as cns
+from misc.cache import LRUCache
+from misc.db import get_engine
+from misc.timetable import get_timetable_source
+from misc.tt_snapshot import normalize_time
+
+
+class PairIndex:
+    """Pairs of a group or teacher for the whole semester, sorted by
+    (week, day, starttime) so that /now and /next are a bisect away."""
+
+    def __init__(self, rows):
+        # rows: [(week, day, starttime, endtime, text), ...]
+        rows = sorted(
+            (week, day, normalize_time(starttime), normalize_time(endtime), text)
+            for week, day, starttime, endtime, text in rows
+        )
+        self.starts = [(week, day, starttime) for week, day, starttime, _, _ in rows]
+        self.endtimes = [endtime for _, _, _, endtime, _ in rows]
+        self.texts = [text for _, _, _, _, text in rows]
+
+    def _slot_end(self, idx: int) -> int:
+        # pairs starting together with the one at idx, e.g. subgroups, end before this
+        slot = self.starts[idx]
+        end = idx
+        while end < len(self.starts) and self.starts[end] == slot:
+            end += 1
+        return end
+
+    def current(self, week: int, day: int, time: str) -> list:
+        """Texts of the pairs going on at time, empty if there are none"""
+        time = normalize_time(time)
+        idx = bisect_right(self.starts, (week, day, time)) - 1
+        if idx < 0 or self.starts[idx][:2] != (week, day):
+            return []
+        slot = self.starts[idx]
+        while idx > 0 and self.starts[idx - 1] == slot:
+            idx -= 1
+        return [
+            self.texts[i] for i in range(idx, self._slot_end(idx))
+            if self.endtimes[i] > time
+        ]
+
+    def next(self, week: int, day: int, time: str):
+        """(week, day, texts) of the first pairs starting after time,
+        on later days and weeks too. None if there are none this semester."""
+        idx = bisect_right(self.starts, (week, day, normalize_time(time)))
+        if idx == len(self.starts):
+            return None
+        next_week, next_day, _ = self.starts[idx]
+        return next_week, next_day, self.texts[idx:self._slot_end(idx)]
+
+
+# (name, is_teacher) -> PairIndex, dropped when the timetable is reloaded
+pair_index_cache = LRUCache('pair_index', cns.PAIR_INDEX_CACHE_SIZE, ttl=cns.PAIR_INDEX_TTL)
+
+
+def load_pair_index(key) -> PairIndex:
+    name, is_teacher = key
+    timetable, name_column, row_template = get_timetable_source(is_teacher)
+    with get_engine().connect() as conn:
+        result = conn.execute(sqlalchemy.text(
+            f"SELECT * FROM {timetable} WHERE {name_column} = :gn"),
+            gn=name
+        )
+        return PairIndex(
+            (row['week'], row['day'], row['starttime'], row['endtime'], row_template(row))
+            for row in result
+        )
+
+
+def get_pair_index(name: str, is_teacher: bool) -> PairIndex:
+    return pair_index_cache.get_or_load((name, is_teacher), load_pair_index)
@@ -0,0 +1,131 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import misc.config as config
+import misc.metrics as metrics
+
+logger = getLogger(__name__)
+
+# Work classes, see WORKER_POOLS in config
+DB_READ = 'db_read'
+DB_WRITE = 'db_write'
+TELEGRAM_IO = 'telegram_io'
+
+
+# Update whose handler submits the work, set by log.instrument
+current_update = contextvars.ContextVar('current_update', default=None)
+
+_error_handler = None
+
+
+def set_error_handler(handler) -> None:
+    """handler(update, error) gets exceptions of submitted work, e.g. Dispatcher.dispatch_error"""
+    global _error_handler
+    _error_handler = handler
+
+
+class PoolOverloaded(Exception):
+    """Raised by submit when the pool queue of the work class is full."""
+
+    def __init__(self, pool_name: str):
+        super().__init__(f'{pool_name} pool is overloaded')
+        self.pool_name = pool_name
+
+
+class WorkerPool:
+    """Thread pool with a bounded queue that rejects work instead of piling it up."""
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f'pool_{name}')
+        # running + queued
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        self._done = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def submit(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PoolOverloaded(self.name)
+        with self._lock:
+            self._pending += 1
+        try:
+            # keeps the logging context of the handler, see misc/log.py
+            return self._executor.submit(
+                self._run, contextvars.copy_context(), func, args, kwargs)
+        except Exception:
+            self._release(failed=True, started=False)
+            raise
+
+    def _run(self, context, func, args, kwargs):
+        with self._lock:
+            self._pending -= 1
+            self._active += 1
+        try:
+            result = context.run(func, *args, **kwargs)
+        except Exception as e:
+            self._release(failed=True)
+            self._report(context, e)
+            raise
+        self._release()
+        return result
+
+    def _report(self, context, error: Exception) -> None:
+        if _error_handler is None:
+            logger.error(f'{self.name} pool: {error}', exc_info=True)
+            return
+        try:
+            _error_handler(context.run(current_update.get), error)
+        except Exception as e:
+            logger.error(f'{self.name} pool error handler: {e}', exc_info=True)
+
+    def _release(self, failed: bool = False, started: bool = True) -> None:
+        with self._lock:
+            if started:
+                self._active -= 1
+            else:
+                self._pending -= 1
+            self._done += 1
+            self._failed += failed
+        self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'queued': self._pending,
+                'active': self._active,
+                'done': self._done,
+                'failed': self._failed,
+                'rejected': self._rejected
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(work_class: str) -> WorkerPool:
+    with _pools_lock:
+        pool = _pools.get(work_class)
+        if pool is None:
+            workers, queue_size = config.WORKER_POOLS[work_class]
+            pool = _pools[work_class] = WorkerPool(work_class, workers, queue_size)
+            metrics.register_stats_source(f'pool_{work_class}', pool.stats)
+        return pool
+
+
+def submit(work_class: str, func, *args, **kwargs):
+    """Run func in the pool of the work class, raises PoolOverloaded if it is full."""
+    return get_pool(work_class).submit(func, *args, **kwargs)
@@ -0,0 +1,52 @@
+import datetime
+from itertools import groupby
+
+import sqlalchemy
+
+from misc.study_calendar import get_study_week
+from misc.timetable import get_timetable_source
+
+
+def render_day_timetables(conn, is_teacher: bool, date: datetime.date) -> list:
+    # Same text as get_group_day_timetable gives on that date, for every name
+    timetable, name_column, row_template = get_timetable_source(is_teacher)
+    week = get_study_week(date)
+    names = [
+        row[name_column] for row in conn.execute(sqlalchemy.text(
+            f'SELECT DISTINCT {name_column} FROM {timetable}'))
+    ]
+    contents = {}
+    if week < 19:
+        rows = conn.execute(
+            sqlalchemy.text(
+                f'SELECT * FROM {timetable} '
+                'WHERE week = :week AND day = :day '
+                f'ORDER BY {name_column}, starttime'
+            ),
+            week=week,
+            day=date.isoweekday()
+        )
+        for name, name_rows in groupby(rows, key=lambda row: row[name_column]):
+            contents[name] = ''.join(map(row_template, name_rows))
+    return [
+        {'name': name, 'is_teacher': is_teacher, 'date': date, 'content': contents.get(name)}
+        for name in names
+    ]
+
+
+def prerender_day_timetables(conn, date: datetime.date) -> int:
+    """Renders day timetables of all groups and teachers into test.tt_prerendered."""
+    rendered = render_day_timetables(conn, False, date) + render_day_timetables(conn, True, date)
+    conn.execute(
+        sqlalchemy.text('DELETE FROM test.tt_prerendered WHERE date < current_date OR date = :date'),
+        date=date
+    )
+    if rendered:
+        conn.execute(
+            sqlalchemy.text(
+                'INSERT INTO test.tt_prerendered (name, is_teacher, date, content) '
+                'VALUES (:name, :is_teacher, :date, :content)'
+            ),
+            rendered
+        )
+    return len(rendered)
@@ -0,0 +1,160 @@
+import datetime
+import time
+from logging import getLogger
+
+import sqlalchemy
+
+import misc.constants as cns
+import misc.metrics as metrics
+from misc.db import get_engine
+from misc.news import get_news_from_db, get_news_page, news_cache
+from misc.pair_index import get_pair_index, pair_index_cache
+from misc.study_calendar import LOCAL_TIMEZONE, get_local_now, get_study_week
+from misc.timetable import get_timetable_source, prerendered_cache
+from misc.tt_snapshot import normalize_time
+
+logger = getLogger(__name__)
+
+# caches whose hit rates are reported for peaks
+PEAK_CACHES = [prerendered_cache, pair_index_cache, news_cache]
+
+
+def load_peak_targets(date: datetime.date) -> list:
+    """[(peak time 'HH:MM', name, is_teacher), ...] of the date, sorted"""
+    timetable, _, _ = get_timetable_source(False)
+    teacher_timetable, _, _ = get_timetable_source(True)
+    with get_engine().connect() as conn:
+        file = open('./misc/sql/select/prewarm_targets.sql')
+        rows = conn.execute(
+            sqlalchemy.text(file.read().format(
+                timetable=timetable, teacher_timetable=teacher_timetable)),
+            week=get_study_week(date),
+            day=date.isoweekday()
+        )
+        return sorted(
+            (normalize_time(row['peak_time']), row['name'], row['is_teacher'])
+            for row in rows
+        )
+
+
+def get_peak_windows(date: datetime.date, targets: list) -> list:
+    """[(start, end, {(name, is_teacher), ...}), ...]: peaks closer than
+    cns.PREWARM_PEAK_WINDOW to each other share one window"""
+    windows = []
+    for peak_time, name, is_teacher in targets:
+        peak = LOCAL_TIMEZONE.localize(
+            datetime.datetime.combine(date, datetime.time.fromisoformat(peak_time)))
+        if windows and peak <= windows[-1][1]:
+            windows[-1][1] = peak + datetime.timedelta(seconds=cns.PREWARM_PEAK_WINDOW)
+        else:
+            windows.append([peak, peak + datetime.timedelta(seconds=cns.PREWARM_PEAK_WINDOW), set()])
+        windows[-1][2].add((name, is_teacher))
+    return [tuple(window) for window in windows]
+
+
+def warm_connections() -> None:
+    # checked out together, so that the pool keeps that many open
+    connections = []
+    try:
+        for _ in range(cns.PREWARM_CONNECTIONS):
+            connections.append(get_engine().connect())
+            connections[-1].execute(sqlalchemy.text('SELECT 1'))
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+def warm_caches(names) -> None:
+    today = get_local_now().date()
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            sqlalchemy.text(
+                'SELECT name, is_teacher, content FROM test.tt_prerendered '
+                'WHERE date = :date AND name = ANY(:names)'
+            ),
+            date=today,
+            names=[name for name, _ in names]
+        ).fetchall()
+    for row in rows:
+        if (row['name'], row['is_teacher']) in names:
+            prerendered_cache.set((row['name'], row['is_teacher'], today), (row['content'],))
+    for name, is_teacher in names:
+        get_pair_index(name, is_teacher)
+    get_news_page()
+    get_news_from_db(cns.DAY_NEWS)
+
+
+def get_cache_counts() -> dict:
+    return {cache.name: (cache.hits, cache.misses) for cache in PEAK_CACHES}
+
+
+class PrewarmScheduler:
+    """Every morning finds the day's peaks from first pairs and message times
+    of the users' groups, and warms caches and connections shortly before each."""
+
+    def __init__(self, job_queue):
+        self.job_queue = job_queue
+        self.windows_count = 0
+        # cache name -> [hits, misses] summed over the peak windows
+        self.peak_counts = {cache.name: [0, 0] for cache in PEAK_CACHES}
+        self.last_window = None
+        metrics.register_stats_source('prewarm', self.stats)
+
+    def start(self) -> None:
+        self.job_queue.run_once(self.plan_day, when=0)
+
+    def plan_day(self, context) -> None:
+        now = get_local_now()
+        # aware, the job queue takes naive datetimes as UTC
+        next_plan = LOCAL_TIMEZONE.localize(datetime.datetime.combine(
+            now.date() + datetime.timedelta(days=1), cns.PREWARM_PLAN_TIME))
+        self.job_queue.run_once(self.plan_day, when=next_plan)
+        try:
+            targets = load_peak_targets(now.date())
+        except Exception as e:
+            logger.error(f'prewarm plan: {e}', exc_info=True)
+            return
+        windows = get_peak_windows(now.date(), targets)
+        for start, end, names in windows:
+            if end <= now:
+                continue
+            warm_at = max(start - datetime.timedelta(seconds=cns.PREWARM_LEAD), now)
+            self.job_queue.run_once(
+                self.warm, when=warm_at, context=(start, end, names))
+        logger.info(f'{len(windows)} peak windows planned for {now.date()}')
+
+    def warm(self, context) -> None:
+        start, end, names = context.job.context
+        start_time = time.monotonic()
+        try:
+            warm_connections()
+            warm_caches(names)
+        except Exception as e:
+            logger.error(f'prewarm: {e}', exc_info=True)
+        logger.info(f'warmed {len(names)} groups for {start:%H:%M} '
+                    f'in {time.monotonic() - start_time:.1f} s')
+        self.job_queue.run_once(
+            self.report, when=end, context=(start, end, get_cache_counts()))
+
+    def report(self, context) -> None:
+        start, end, counts_before = context.job.context
+        window = {}
+        for name, (hits, misses) in get_cache_counts().items():
+            peak_hits = hits - counts_before[name][0]
+            peak_misses = misses - counts_before[name][1]
+            self.peak_counts[name][0] += peak_hits
+            self.peak_counts[name][1] += peak_misses
+            window[name] = get_hit_rate(peak_hits, peak_misses)
+        self.windows_count += 1
+        self.last_window = f'{start:%H:%M}-{end:%H:%M} {window}'
+        logger.info(f'peak {self.last_window}')
+
+    def stats(self) -> dict:
+        result = {'windows': self.windows_count, 'last_window': self.last_window}
+        for name, (hits, misses) in self.peak_counts.items():
+            result[f'{name}_peak_hit_rate'] = get_hit_rate(hits, misses)
+        return result
+
+
+def get_hit_rate(hits: int, misses: int) -> float:
+    return round(hits / (hits + misses), 3) if hits + misses else 0
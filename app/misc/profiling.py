@@ -0,0 +1,167 @@
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from logging import getLogger
+
+import misc.config as config
+import misc.constants as cns
+import misc.metrics as metrics
+
+logger = getLogger(__name__)
+
+# Output is in collapsed stack format ("root;...;leaf count" per line),
+# the input of flamegraph.pl, speedscope and similar tools
+
+
+def collapse_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def write_collapsed(name: str, samples: Counter) -> str:
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(config.PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f'{stack} {count}\n')
+    return path
+
+
+class SlowHandlerWatchdog:
+    """Samples the stack of handlers running longer than threshold_ms
+    and writes the samples when the handler finishes."""
+
+    def __init__(self, threshold_ms: float, check_interval: float):
+        self.threshold = threshold_ms / 1000
+        self.check_interval = check_interval
+        # thread id -> (handler name, start time, stack samples)
+        self._active = {}
+        threading.Thread(target=self._watch, name='slow_handler_watchdog', daemon=True).start()
+
+    def begin(self, handler_name: str) -> None:
+        self._active[threading.get_ident()] = (handler_name, time.monotonic(), Counter())
+
+    def end(self) -> None:
+        handler_name, start_time, samples = self._active.pop(threading.get_ident())
+        if samples:
+            metrics.inc('slow_handlers')
+            path = write_collapsed(f'slow-{handler_name}', samples)
+            logger.warning(
+                f'{handler_name} took {(time.monotonic() - start_time) * 1000:.0f} ms, '
+                f'stack samples in {path}')
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(self.check_interval)
+            now = time.monotonic()
+            slow = [
+                (thread_id, samples)
+                for thread_id, (_, start_time, samples) in list(self._active.items())
+                if now - start_time > self.threshold
+            ]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in slow:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[collapse_stack(frame)] += 1
+
+
+class SamplingProfiler:
+    """Samples stacks of all threads while running."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._samples = Counter()
+        self._stop_event = None
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._stop_event is not None
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._samples = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, args=(self._stop_event,),
+            name='sampling_profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """Stops sampling and returns path of the written profile."""
+        if not self.running:
+            return None
+        self._stop_event.set()
+        self._stop_event = None
+        self._thread.join()
+        return write_collapsed('profile', self._samples)
+
+    def _sample(self, stop_event: threading.Event) -> None:
+        own_id = threading.get_ident()
+        thread_names = {}
+        while not stop_event.wait(self.interval):
+            if len(thread_names) != threading.active_count():
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    thread_name = thread_names.get(thread_id, thread_id)
+                    self._samples[f'{thread_name};{collapse_stack(frame)}'] += 1
+
+
+def toggle_tracemalloc() -> str:
+    """Starts tracing allocations, or dumps and stops the running trace.
+    Returns path of the collapsed dump, None if tracing was started."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(cns.TRACEMALLOC_FRAMES)
+        return None
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    # allocated bytes by allocation stack
+    samples = Counter()
+    for stat in snapshot.statistics('traceback'):
+        stack = ';'.join(
+            f'{os.path.basename(frame.filename)}:{frame.lineno}'
+            for frame in reversed(stat.traceback))
+        samples[stack] += stat.size
+    path = write_collapsed('memory', samples)
+    snapshot.dump(f'{path[:-len(".folded")]}.tracemalloc')
+    return path
+
+
+def toggle_sampling_profiler() -> str:
+    """Starts the sampling profiler, or stops it and returns path of the profile."""
+    if sampling_profiler.running:
+        return sampling_profiler.stop()
+    sampling_profiler.start()
+    return None
+
+
+def install_signal_handlers() -> None:
+    # SIGUSR1 toggles the sampling profiler, SIGUSR2 the allocation trace
+    def on_signal(toggle):
+        def handler(signum, frame):
+            path = toggle()
+            logger.warning(f'{toggle.__name__}: ' + (f'written {path}' if path else 'started'))
+        return handler
+    signal.signal(signal.SIGUSR1, on_signal(toggle_sampling_profiler))
+    signal.signal(signal.SIGUSR2, on_signal(toggle_tracemalloc))
+
+
+sampling_profiler = SamplingProfiler(cns.PROFILER_SAMPLE_INTERVAL)
+
+# None when SLOW_HANDLER_THRESHOLD_MS is not set
+slow_handler_watchdog = SlowHandlerWatchdog(
+    config.SLOW_HANDLER_THRESHOLD_MS, cns.SLOW_HANDLER_CHECK_INTERVAL
+) if config.SLOW_HANDLER_THRESHOLD_MS is not None else None
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+import misc.config as config
+import misc.constants as cns
+import misc.metrics as metrics
+
+
+class TokenBucketLimiter:
+    """Token bucket per key: `burst` requests at once, refilled at `rate` per second.
+    Only the last `maxsize` keys are kept, a forgotten key starts with a full bucket."""
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # key -> [tokens, time of the last refill]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.throttled = 0
+
+    def allow(self, key) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                self.throttled += 1
+                return False
+            bucket[0] -= 1
+            self.allowed += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'keys': len(self._buckets),
+                'allowed': self.allowed,
+                'throttled': self.throttled
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(handler_class: str) -> TokenBucketLimiter:
+    with _limiters_lock:
+        limiter = _limiters.get(handler_class)
+        if limiter is None:
+            rate, burst = config.RATE_LIMITS[handler_class]
+            limiter = _limiters[handler_class] = TokenBucketLimiter(
+                rate, burst, cns.RATE_LIMIT_USERS)
+            metrics.register_stats_source(f'rate_limit_{handler_class}', limiter.stats)
+        return limiter
+
+
+def allow(handler_class: str, user_id: int) -> bool:
+    """False if the user ran out of the budget of the handler class, see RATE_LIMITS in config"""
+    return get_limiter(handler_class).allow(user_id)
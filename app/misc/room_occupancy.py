@@ -0,0 +1,87 @@
+from collections import defaultdict
+
+WEEKS_COUNT = 18
+DAYS_PER_WEEK = 7
+PAIRS_PER_DAY = 8
+SLOTS_COUNT = WEEKS_COUNT * DAYS_PER_WEEK * PAIRS_PER_DAY
+OCCUPANCY_BYTES = (SLOTS_COUNT + 7) // 8
+
+
+def slot_bit(week: int, day: int, pair: int) -> int:
+    return ((week - 1) * DAYS_PER_WEEK + (day - 1)) * PAIRS_PER_DAY + (pair - 1)
+
+
+def is_valid_slot(week: int, day: int, pair: int) -> bool:
+    # rows with NULL pair_number and such are skipped
+    if week is None or day is None or pair is None:
+        return False
+    return 1 <= week <= WEEKS_COUNT and 1 <= day <= DAYS_PER_WEEK and 1 <= pair <= PAIRS_PER_DAY
+
+
+def split_rooms(rooms: str) -> list:
+    return [room.strip() for room in rooms.split(',') if room.strip()]
+
+
+def get_building(room: str) -> str:
+    # "7-505" is room 505 in building 7
+    return room.split('-', 1)[0] if '-' in room else room
+
+
+def build_room_occupancy(rows) -> dict:
+    """rows of (rooms, week, day, pair_number) -> {room: occupancy bitset}"""
+    occupancy = defaultdict(int)
+    for rooms, week, day, pair in rows:
+        if rooms is None or not is_valid_slot(week, day, pair):
+            continue
+        for room in split_rooms(rooms):
+            occupancy[room] |= 1 << slot_bit(week, day, pair)
+    return dict(occupancy)
+
+
+def occupancy_to_bytes(occupancy: int) -> bytes:
+    return occupancy.to_bytes(OCCUPANCY_BYTES, 'big')
+
+
+def occupancy_from_bytes(data: bytes) -> int:
+    return int.from_bytes(data, 'big')
+
+
+class RoomOccupancy:
+    """Room occupancy, transposed so that a slot query is a couple of bitwise ops."""
+
+    def __init__(self, occupancy: dict, pair_times=()):
+        self.occupancy = occupancy
+        # (pair_number, 'HH:MM' start, 'HH:MM' end) sorted by pair_number
+        self.pair_times = list(pair_times)
+        self.rooms = sorted(occupancy)
+        self.all_rooms_mask = (1 << len(self.rooms)) - 1
+        # building -> bitset over room indices
+        self.building_masks = defaultdict(int)
+        # slot bit -> bitset over room indices of occupied rooms
+        self.slot_masks = defaultdict(int)
+        for room_idx, room in enumerate(self.rooms):
+            room_bit = 1 << room_idx
+            self.building_masks[get_building(room)] |= room_bit
+            room_occupancy = occupancy[room]
+            while room_occupancy:
+                lowest = room_occupancy & -room_occupancy
+                self.slot_masks[lowest.bit_length() - 1] |= room_bit
+                room_occupancy ^= lowest
+
+    def get_pair_at(self, time_str: str):
+        # current pair, or the next one if we are between pairs
+        for pair, _starttime, endtime in self.pair_times:
+            if time_str < endtime:
+                return pair
+        return None
+
+    def is_free(self, room: str, week: int, day: int, pair: int) -> bool:
+        return not (self.occupancy.get(room, 0) >> slot_bit(week, day, pair)) & 1
+
+    def free_rooms(self, week: int, day: int, pair: int, building: str = None) -> list:
+        if not is_valid_slot(week, day, pair):
+            return []
+        candidates = self.building_masks.get(building, 0) if building is not None \
+            else self.all_rooms_mask
+        free_mask = candidates & ~self.slot_masks.get(slot_bit(week, day, pair), 0)
+        return [room for room_idx, room in enumerate(self.rooms) if (free_mask >> room_idx) & 1]
@@ -0,0 +1,10 @@
+CREATE TABLE test.group_ics
+(
+    group_name character varying COLLATE pg_catalog."default" NOT NULL,
+    content text NOT NULL,
+    content_hash character varying NOT NULL,
+    -- telegram file_id of the uploaded document, NULL until first upload
+    file_id character varying,
+    date_add timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT group_ics_pkey PRIMARY KEY (group_name)
+)
@@ -7,5 +7,9 @@ create table test.news
     title     varchar,
     shorttext varchar,
     news_date timestamp with time zone,
-    date_add  timestamp with time zone default now() not null
-);
\ No newline at end of file
+    date_add  timestamp with time zone default now() not null,
+    search_vector tsvector,
+    display_html text
+);
+create index news_search_vector_idx on test.news using gin (search_vector);
+create index news_date_idx on test.news (news_date, id);
@@ -0,0 +1,7 @@
+CREATE TABLE test.news_backfill_day
+(
+    -- days already loaded by update/backfill_news.py
+    day date NOT NULL,
+    date_add timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT news_backfill_day_pkey PRIMARY KEY (day)
+)
@@ -0,0 +1,9 @@
+CREATE TABLE test.room_occupancy
+(
+    room character varying COLLATE pg_catalog."default" NOT NULL,
+    building character varying COLLATE pg_catalog."default",
+    -- bitset over (week, day, pair), see misc/room_occupancy.py
+    occupancy bytea NOT NULL,
+    date_add timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT room_occupancy_pkey PRIMARY KEY (room)
+)
@@ -0,0 +1,7 @@
+-- migrate/*.sql applied by update/migrate.py
+CREATE TABLE IF NOT EXISTS test.schema_migration
+(
+    name character varying NOT NULL,
+    date_add timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT schema_migration_pkey PRIMARY KEY (name)
+);
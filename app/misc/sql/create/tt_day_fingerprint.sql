@@ -0,0 +1,9 @@
+CREATE TABLE test.tt_day_fingerprint
+(
+    group_name character varying COLLATE pg_catalog."default" NOT NULL,
+    week smallint NOT NULL,
+    day smallint NOT NULL,
+    -- md5 of the day's pairs, see select/tt_day_fingerprints.sql
+    fingerprint text NOT NULL,
+    CONSTRAINT tt_day_fingerprint_pkey PRIMARY KEY (group_name, week, day)
+)
@@ -0,0 +1,44 @@
+CREATE MATERIALIZED VIEW test.tt_group_week AS
+SELECT tt.group_name,
+       w.week,
+       tt.day,
+       tt.starttime,
+       tt.endtime,
+       tt.pair_number,
+       tt.tsw_name,
+       tt.classname,
+       tt.rooms,
+       tt.teacher1,
+       tt.teacher2,
+       tt.pk
+FROM test.tt_new tt
+    CROSS JOIN LATERAL (VALUES
+        (1, tt.week1),
+        (2, tt.week2),
+        (3, tt.week3),
+        (4, tt.week4),
+        (5, tt.week5),
+        (6, tt.week6),
+        (7, tt.week7),
+        (8, tt.week8),
+        (9, tt.week9),
+        (10, tt.week10),
+        (11, tt.week11),
+        (12, tt.week12),
+        (13, tt.week13),
+        (14, tt.week14),
+        (15, tt.week15),
+        (16, tt.week16),
+        (17, tt.week17),
+        -- 18 (зачетная) неделя
+        (18, (tt.is_odd = -1 AND tt.week18) OR tt.is_odd = 0)
+    ) AS w (week, has_class)
+WHERE w.has_class;
+
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index
+CREATE UNIQUE INDEX tt_group_week_pkey
+    ON test.tt_group_week (group_name, week, day, pk);
+
+CREATE INDEX tt_group_week_covering_idx
+    ON test.tt_group_week (group_name, week, day, starttime)
+    INCLUDE (endtime, pair_number, tsw_name, classname, rooms, teacher1, teacher2);
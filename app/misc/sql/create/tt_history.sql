@@ -0,0 +1,12 @@
+-- Rows of test.tt_group_week of every semester, one partition per semester
+-- (get_timetable_name), written by update_tt_cell.py after each load.
+-- The bot reads the current semester from the views and past ones from here.
+CREATE TABLE IF NOT EXISTS test.tt_history
+(
+    semester character varying NOT NULL,
+    LIKE test.tt_group_week
+) PARTITION BY LIST (semester);
+
+-- created on every partition
+CREATE INDEX IF NOT EXISTS tt_history_group_idx
+    ON test.tt_history (group_name, week, day, starttime);
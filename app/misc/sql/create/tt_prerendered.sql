@@ -0,0 +1,11 @@
+CREATE TABLE test.tt_prerendered
+(
+    -- group name, or teacher name if is_teacher
+    name character varying COLLATE pg_catalog."default" NOT NULL,
+    is_teacher boolean NOT NULL,
+    date date NOT NULL,
+    -- NULL if there are no pairs that day
+    content text,
+    date_add timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT tt_prerendered_pkey PRIMARY KEY (name, is_teacher, date)
+)
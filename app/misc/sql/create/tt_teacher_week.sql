@@ -0,0 +1,28 @@
+-- teacher -> timetable rows, built from test.tt_group_week after each load.
+-- A pair that several groups share with one teacher becomes a single row.
+CREATE MATERIALIZED VIEW test.tt_teacher_week AS
+SELECT t.teacher_name,
+       tt.week,
+       tt.day,
+       tt.starttime,
+       tt.endtime,
+       tt.pair_number,
+       tt.tsw_name,
+       tt.classname,
+       tt.rooms,
+       string_agg(DISTINCT tt.group_name, ', ') AS group_names,
+       min(tt.pk)                               AS pk
+FROM test.tt_group_week tt
+    CROSS JOIN LATERAL (VALUES (tt.teacher1), (tt.teacher2)) AS t (teacher_name)
+WHERE t.teacher_name IS NOT NULL
+  AND t.teacher_name <> ''
+GROUP BY t.teacher_name, tt.week, tt.day, tt.starttime, tt.endtime,
+         tt.pair_number, tt.tsw_name, tt.classname, tt.rooms;
+
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index
+CREATE UNIQUE INDEX tt_teacher_week_pkey
+    ON test.tt_teacher_week (teacher_name, week, day, pk);
+
+CREATE INDEX tt_teacher_week_covering_idx
+    ON test.tt_teacher_week (teacher_name, week, day, starttime)
+    INCLUDE (endtime, pair_number, tsw_name, classname, rooms, group_names);
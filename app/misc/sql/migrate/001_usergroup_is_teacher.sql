@@ -0,0 +1,2 @@
+ALTER TABLE users.usergroup
+    ADD COLUMN IF NOT EXISTS is_teacher boolean NOT NULL DEFAULT false;
@@ -0,0 +1,10 @@
+ALTER TABLE test.news
+    ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE test.news
+SET search_vector = setweight(to_tsvector('russian', coalesce(title, '')), 'A')
+                 || setweight(to_tsvector('russian', coalesce(shorttext, '')), 'B')
+WHERE search_vector IS NULL;
+
+CREATE INDEX IF NOT EXISTS news_search_vector_idx
+    ON test.news USING gin (search_vector);
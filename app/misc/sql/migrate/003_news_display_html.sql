@@ -0,0 +1,3 @@
+-- filled by fill_news_display_html right after this, see update/migrate.py
+ALTER TABLE test.news
+    ADD COLUMN IF NOT EXISTS display_html text;
@@ -0,0 +1,27 @@
+-- the weeks_mask column of create/tt_cell.sql for existing tables
+ALTER TABLE test.tt_cell
+    ADD COLUMN IF NOT EXISTS weeks_mask integer GENERATED ALWAYS AS (
+        coalesce(week1, false)::integer
+        | (coalesce(week2, false)::integer << 1)
+        | (coalesce(week3, false)::integer << 2)
+        | (coalesce(week4, false)::integer << 3)
+        | (coalesce(week5, false)::integer << 4)
+        | (coalesce(week6, false)::integer << 5)
+        | (coalesce(week7, false)::integer << 6)
+        | (coalesce(week8, false)::integer << 7)
+        | (coalesce(week9, false)::integer << 8)
+        | (coalesce(week10, false)::integer << 9)
+        | (coalesce(week11, false)::integer << 10)
+        | (coalesce(week12, false)::integer << 11)
+        | (coalesce(week13, false)::integer << 12)
+        | (coalesce(week14, false)::integer << 13)
+        | (coalesce(week15, false)::integer << 14)
+        | (coalesce(week16, false)::integer << 15)
+        | (coalesce(week17, false)::integer << 16)
+        | (coalesce((is_odd = -1 AND week18) OR is_odd = 0, false)::integer << 17)
+    ) STORED;
+
+-- Both views are rebuilt from create/*.sql by the next update_tt_cell.py run,
+-- until then the bot reads groups from the timetable snapshot
+DROP MATERIALIZED VIEW IF EXISTS test.tt_teacher_week;
+DROP MATERIALIZED VIEW IF EXISTS test.tt_group_week;
@@ -0,0 +1,3 @@
+-- day ranges and keyset pages of misc/news.py
+CREATE INDEX IF NOT EXISTS news_date_idx
+    ON test.news (news_date, id);
@@ -0,0 +1,14 @@
+-- Messages of other processes for the bot to send, see misc/outbox.py
+CREATE TABLE IF NOT EXISTS test.delivery_outbox
+(
+    id bigserial NOT NULL,
+    priority smallint NOT NULL,
+    chat_id bigint NOT NULL,
+    text text NOT NULL,
+    options jsonb NOT NULL DEFAULT '{}',
+    date_add timestamp without time zone NOT NULL DEFAULT now(),
+    CONSTRAINT delivery_outbox_pkey PRIMARY KEY (id)
+);
+
+CREATE INDEX IF NOT EXISTS delivery_outbox_priority_idx
+    ON test.delivery_outbox (priority, id);
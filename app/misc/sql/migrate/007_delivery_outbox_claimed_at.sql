@@ -0,0 +1,4 @@
+-- Rows are deleted only after they are sent, claimed_at marks the ones
+-- the bot has already queued, see drain_outbox
+ALTER TABLE test.delivery_outbox
+    ADD COLUMN IF NOT EXISTS claimed_at timestamp without time zone;
@@ -0,0 +1,8 @@
+-- Reverts 004: the bot reads weeks from the (name, week, ...) indexes of the
+-- views, weeks_mask had no reader besides the view definition.
+-- Both views are rebuilt from create/*.sql by the next update_tt_cell.py run,
+-- until then the bot reads groups from the timetable snapshot
+DROP MATERIALIZED VIEW IF EXISTS test.tt_teacher_week;
+DROP MATERIALIZED VIEW IF EXISTS test.tt_group_week;
+
+ALTER TABLE test.tt_cell DROP COLUMN IF EXISTS weeks_mask;
@@ -1,81 +1,12 @@
-SELECT *
-FROM (SELECT *
-      FROM test.unpivoted_weeks
-      WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-        AND week = :week_num
-        AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-        AND starttime > to_char(now() AT TIME ZONE 'Asia/Novosibirsk', 'HH24:MI')
-        AND pk = (SELECT pk
-                  FROM test.unpivoted_weeks
-                  WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                    AND week = :week_num
-                    AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                  ORDER BY starttime
-                  LIMIT 1)
-      UNION ALL
-      SELECT *
-      FROM test.unpivoted_weeks
-      WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-        AND week = :week_num
-        AND day > extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-        AND NOT EXISTS(SELECT 1
-                       FROM test.unpivoted_weeks
-                       WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                         AND week = :week_num
-                         AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                         AND starttime > to_char(now() AT TIME ZONE 'Asia/Novosibirsk', 'HH24:MI')
-                         AND pk = (SELECT pk
-                                   FROM test.unpivoted_weeks
-                                   WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                                     AND week = :week_num
-                                     AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                                   ORDER BY starttime
-                                   LIMIT 1)
-          )
-      ORDER BY week, day, starttime
-     ) as tr
-UNION ALL
-SELECT *
-FROM test.unpivoted_weeks
-WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-  AND week > :week_num
-  AND NOT EXISTS(SELECT 1
-                 FROM (SELECT *
-                       FROM test.unpivoted_weeks
-                       WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                         AND week = :week_num
-                         AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                         AND starttime > to_char(now() AT TIME ZONE 'Asia/Novosibirsk', 'HH24:MI')
-                         AND pk = (SELECT pk
-                                   FROM test.unpivoted_weeks
-                                   WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                                     AND week = :week_num
-                                     AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                                   ORDER BY starttime
-                                   LIMIT 1)
-                       UNION ALL
-                       SELECT *
-                       FROM test.unpivoted_weeks
-                       WHERE group_name = (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                         AND week = :week_num
-                         AND day > extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                         AND NOT EXISTS(SELECT 1
-                                        FROM test.unpivoted_weeks
-                                        WHERE group_name =
-                                              (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                                          AND week = :week_num
-                                          AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                                          AND starttime > to_char(now() AT TIME ZONE 'Asia/Novosibirsk', 'HH24:MI')
-                                          AND pk = (SELECT pk
-                                                    FROM test.unpivoted_weeks
-                                                    WHERE group_name =
-                                                          (SELECT group_name FROM users.usergroup WHERE user_id = :uid)
-                                                      AND week = :week_num
-                                                      AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
-                                                    ORDER BY starttime
-                                                    LIMIT 1)
-                           )
-                       ORDER BY week, day, starttime
-                      ) as tr)
-ORDER BY week, day, starttime
+SELECT week, day, min(starttime) AS starttime
+FROM {timetable}
+WHERE {name_column} = :gn
+  AND (week > :week_num
+    OR (week = :week_num AND day >= extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')))
+GROUP BY week, day
+-- today counts only if its first pair hasn't started yet
+HAVING NOT (week = :week_num
+    AND day = extract(isodow from now() AT TIME ZONE 'Asia/Novosibirsk')
+    AND min(starttime) <= to_char(now() AT TIME ZONE 'Asia/Novosibirsk', 'HH24:MI'))
+ORDER BY week, day
 LIMIT 1
\ No newline at end of file
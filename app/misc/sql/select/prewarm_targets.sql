@@ -0,0 +1,20 @@
+-- (name, is_teacher, peak_time 'HH:MM') when users of a group or teacher
+-- are expected: before the first pair of the day and at their timetable
+-- message time
+SELECT tt.group_name AS name, false AS is_teacher, min(tt.starttime) AS peak_time
+FROM {timetable} tt
+WHERE tt.week = :week
+  AND tt.day = :day
+  AND tt.group_name IN (SELECT group_name FROM users.usergroup WHERE NOT is_teacher)
+GROUP BY tt.group_name
+UNION
+SELECT tt.teacher_name, true, min(tt.starttime)
+FROM {teacher_timetable} tt
+WHERE tt.week = :week
+  AND tt.day = :day
+  AND tt.teacher_name IN (SELECT group_name FROM users.usergroup WHERE is_teacher)
+GROUP BY tt.teacher_name
+UNION
+SELECT group_name, is_teacher, to_char(send_msg_time, 'HH24:MI')
+FROM users.usergroup
+WHERE send_msg_time IS NOT NULL
@@ -0,0 +1,8 @@
+SELECT group_name, week, day,
+       md5(string_agg(
+           concat_ws('|', starttime, endtime, pair_number, tsw_name,
+                     classname, rooms, teacher1, teacher2),
+           ';' ORDER BY starttime, pk)) AS fingerprint
+FROM {timetable}
+WHERE week = ANY(:weeks)
+GROUP BY group_name, week, day
@@ -0,0 +1,69 @@
+import datetime
+import locale
+import threading
+
+import pytz
+
+import misc.config as config
+
+_ru_locale_set = False
+_ru_locale_lock = threading.Lock()
+
+
+def set_ru_locale() -> None:
+    # for datetime format, set once and only by the code that renders dates
+    global _ru_locale_set
+    with _ru_locale_lock:
+        if not _ru_locale_set:
+            locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
+            _ru_locale_set = True
+
+
+LOCAL_TIMEZONE = pytz.timezone(config.TIMEZONE)
+
+
+def get_local_now() -> datetime.datetime:
+    """Aware current time in config.TIMEZONE, the zone of SQL_NOW and of timetable times"""
+    return datetime.datetime.now(LOCAL_TIMEZONE)
+
+
+def get_first_study_day_date() -> datetime.date:
+    if datetime.date.today().month < 8 and datetime.date.today().month > 2:
+        return datetime.date(datetime.date.today().year, 9, 1)
+    else:
+        return datetime.date(datetime.date.today().year, 9, 1)
+
+
+def get_semester(date: datetime.date) -> str:
+    # '2026_autumn' from August to January, '2026_spring' from February to July
+    if date.month >= 8:
+        return f'{date.year}_autumn'
+    if date.month == 1:
+        return f'{date.year - 1}_autumn'
+    return f'{date.year}_spring'
+
+
+def get_previous_semester(semester: str) -> str:
+    year, season = semester.split('_')
+    return f'{year}_spring' if season == 'autumn' else f'{int(year) - 1}_autumn'
+
+
+def get_days_by_week(week_to_check: int) -> list:
+    set_ru_locale()
+    given_week_rnd_day = get_first_study_day_date(
+    ) + datetime.timedelta(weeks=week_to_check - 1)
+    dates = [given_week_rnd_day + datetime.timedelta(days=i) for i in range(
+        0 - given_week_rnd_day.weekday(), 7 - given_week_rnd_day.weekday())]
+    # days = [datetime.datetime.strptime(str(year) + "-" + str(week - 1) 
+    # + "-" + str(x), "%Y-%W-%u") for x in range(1, 8)]
+    dates_strings = [datetime.date.strftime(
+        day, '%a. %d %B %Y') for day in dates]
+    return dates_strings
+
+
+def get_study_week(date: datetime.date) -> int:
+    return date.isocalendar()[1] - get_first_study_day_date().isocalendar()[1] + 1
+
+
+def get_current_week() -> int:
+    return get_study_week(datetime.date.today())
@@ -0,0 +1,285 @@
+import datetime
+import time
+from dataclasses import dataclass
+from itertools import groupby
+from logging import getLogger
+
+import sqlalchemy
+
+import misc.config as config
+import misc.constants as cns
+import misc.metrics as metrics
+from misc.cache import LRUCache
+from misc.db import get_engine
+from misc.study_calendar import (get_days_by_week, get_local_now, get_semester,
+                                 get_study_week)
+from misc.tt_snapshot import get_timetable_snapshot
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class UserGroup:
+    # group name, or teacher name if is_teacher
+    name: str
+    is_teacher: bool = False
+
+
+# user_id -> UserGroup, written through in init_user and select_group
+user_group_cache = LRUCache('user_group', cns.USER_GROUP_CACHE_SIZE)
+
+# (name, is_teacher, date) -> (text,), see get_prerendered_day_timetable
+prerendered_cache = LRUCache(
+    'prerendered', cns.PRERENDERED_CACHE_SIZE, ttl=cns.PRERENDERED_CACHE_TTL)
+
+# Timetables are read from the snapshot until then, see get_timetable_rows
+db_degraded_until = 0.0
+
+
+def TIMETABLE_ROW_TEMPLATE(row) -> str:
+    return (
+        f"[{row['pair_number']}] {row['starttime']}-{row['endtime']} "
+        f"{'[' + row['tsw_name'] + '] ' if row['tsw_name'] is not None else ''} "
+        f"{row['classname']} {row['rooms'] if row['rooms'] is not None else ''} "
+        f"{row['teacher1']} {row['teacher2']}\n"
+    )
+
+
+def TEACHER_TIMETABLE_ROW_TEMPLATE(row) -> str:
+    return (
+        f"[{row['pair_number']}] {row['starttime']}-{row['endtime']} "
+        f"{'[' + row['tsw_name'] + '] ' if row['tsw_name'] is not None else ''} "
+        f"{row['classname']} {row['rooms'] if row['rooms'] is not None else ''} "
+        f"{row['group_names']}\n"
+    )
+
+
+def load_user_group(user_id: int):
+    with get_engine().connect() as conn:
+        result = conn.execute(sqlalchemy.text(
+            "SELECT group_name, is_teacher FROM users.usergroup WHERE user_id = :uid"),
+            uid=user_id
+        )
+        row = result.fetchone()
+        return UserGroup(row['group_name'], row['is_teacher']) if row is not None else None
+
+
+def get_user_group(user_id: int) -> UserGroup:
+    return user_group_cache.get_or_load(user_id, load_user_group)
+
+
+def get_timetable_source(is_teacher: bool):
+    # (view, column with group or teacher name, row template)
+    if is_teacher:
+        return cns.TEACHER_TIMETABLE_WEEK_VIEW_NAME, 'teacher_name', TEACHER_TIMETABLE_ROW_TEMPLATE
+    return cns.TIMETABLE_WEEK_VIEW_NAME, 'group_name', TIMETABLE_ROW_TEMPLATE
+
+
+def get_timetable_name(semester: str = None) -> str:
+    """Partition of cns.TIMETABLE_NAME for the semester, the current one by default"""
+    return f'{cns.TIMETABLE_NAME}_{semester or get_semester(datetime.date.today())}'
+
+
+def get_user_day_timetable(user_id: int):
+    user_group = get_user_group(user_id)
+    if user_group is None:
+        return None
+    # one date for both, the prerendered text and the fallback must agree
+    date = get_local_now().date()
+    prerendered = get_prerendered_day_timetable(user_group.name, user_group.is_teacher, date)
+    if prerendered is not None:
+        return prerendered[0]
+    return get_group_day_timetable(user_group.name, user_group.is_teacher, date)
+
+
+def load_prerendered_day_timetable(key):
+    name, is_teacher, date = key
+    try:
+        with get_engine().connect() as conn:
+            row = conn.execute(sqlalchemy.text(
+                "SELECT content FROM test.tt_prerendered "
+                "WHERE name = :name AND is_teacher = :is_teacher AND date = :date"),
+                name=name,
+                is_teacher=is_teacher,
+                date=date
+            ).fetchone()
+    except sqlalchemy.exc.DBAPIError as e:
+        logger.warning(f'prerendered timetable of {name}: {e}')
+        return None
+    # a tuple, so that a day without pairs is cached too
+    return (row['content'],) if row is not None else None
+
+
+def get_prerendered_day_timetable(name: str, is_teacher: bool, date: datetime.date):
+    """(text or None if no pairs,) rendered by update/prerender_tt.py, None if not rendered"""
+    return prerendered_cache.get_or_load((name, is_teacher, date), load_prerendered_day_timetable)
+
+
+def get_timetable_rows_from_db(group_name: str, is_teacher: bool, week: int,
+                               day: int = None, is_rest_week: bool = False) -> list:
+    timetable, name_column, row_template = get_timetable_source(is_teacher)
+    rest_week_sql = f'AND ((day = EXTRACT(isodow from {config.SQL_NOW}) '\
+                    f'AND endtime > to_char({config.SQL_NOW}, \'HH24:MI\')) '\
+                    f'OR (day>EXTRACT(isodow from {config.SQL_NOW})))'
+    params = {'gn': group_name, 'week': week}
+    if day is not None:
+        params['day'] = day
+    with get_engine().begin() as conn:
+        conn.execute(sqlalchemy.text(
+            f'SET LOCAL statement_timeout = {cns.TIMETABLE_DB_TIMEOUT_MS}'))
+        result = conn.execute(sqlalchemy.text(
+            "SELECT * "
+            f"FROM {timetable} "
+            f"WHERE {name_column} = :gn "
+            "AND week = :week "
+            f"{'AND day = :day' if day is not None else ''} "
+            f"{rest_week_sql if is_rest_week else ''} "
+            "ORDER BY day, starttime"),
+            **params
+        )
+        return [(row['day'], row_template(row)) for row in result]
+
+
+def get_timetable_rows_from_snapshot(group_name: str, week: int,
+                                     day: int = None, is_rest_week: bool = False):
+    snapshot = get_timetable_snapshot(config.TIMETABLE_SNAPSHOT_PATH)
+    if snapshot is None:
+        return None
+    rows = snapshot.get_rows(group_name, week, day)
+    if is_rest_week:
+        # the same clock as SQL_NOW of get_timetable_rows_from_db
+        now = get_local_now()
+        today, now_time = now.isoweekday(), now.strftime('%H:%M')
+        rows = [
+            row for row in rows
+            if row[0] > today or (row[0] == today and row[1] > now_time)
+        ]
+    return [(row_day, text) for row_day, _endtime, text in rows]
+
+
+def get_timetable_rows(group_name: str, is_teacher: bool, week: int,
+                       day: int = None, is_rest_week: bool = False) -> list:
+    # [(day, row text), ...] from the database, or from the snapshot
+    # written by update_tt_cell.py when the database is slow or down
+    global db_degraded_until
+    if is_teacher or time.monotonic() >= db_degraded_until:
+        start_time = time.monotonic()
+        try:
+            rows = get_timetable_rows_from_db(group_name, is_teacher, week, day, is_rest_week)
+            if (time.monotonic() - start_time) * 1000 > cns.TIMETABLE_DB_LATENCY_THRESHOLD_MS:
+                metrics.inc('timetable_db_slow')
+                db_degraded_until = time.monotonic() + cns.DB_DEGRADED_SECONDS
+            metrics.inc('timetable_source_db')
+            return rows
+        except sqlalchemy.exc.DBAPIError as e:
+            # Snapshot has only groups
+            if is_teacher:
+                raise
+            logger.warning(f'timetable database error, trying snapshot: {e}')
+            db_degraded_until = time.monotonic() + cns.DB_DEGRADED_SECONDS
+            rows = get_timetable_rows_from_snapshot(group_name, week, day, is_rest_week)
+            if rows is None:
+                raise
+    else:
+        rows = get_timetable_rows_from_snapshot(group_name, week, day, is_rest_week)
+        if rows is None:
+            db_degraded_until = 0.0
+            return get_timetable_rows(group_name, is_teacher, week, day, is_rest_week)
+    metrics.inc('timetable_source_snapshot')
+    logger.info(f'timetable for {group_name} served from snapshot')
+    return rows
+
+
+def get_group_day_timetable(group_name: str, is_teacher: bool = False,
+                            date: datetime.date = None):
+    """Timetable of the date, today in config.TIMEZONE by default"""
+    date = date or get_local_now().date()
+    current_week = get_study_week(date)
+    if current_week < 19:
+        rows = get_timetable_rows(
+            group_name, is_teacher, current_week, day=date.isoweekday())
+        if not rows:
+            return None
+        else:
+            return ''.join(text for _day, text in rows)
+
+
+def get_user_week_timetable(user_id: int, week_to_check, is_rest_week):
+    user_group = get_user_group(user_id)
+    if user_group is None:
+        return []
+    return get_group_week_timetable(
+        user_group.name, week_to_check, is_rest_week, is_teacher=user_group.is_teacher)
+
+
+def get_group_week_timetable(group_name: str, week_to_check, is_rest_week, is_teacher: bool = False):
+    days_of_given_week = get_days_by_week(week_to_check)
+    rows = get_timetable_rows(group_name, is_teacher, week_to_check, is_rest_week=is_rest_week)
+    days_timetable_list = []
+    for day_idx, day_rows in groupby(rows, key=lambda row: row[0]):
+        current_day_text = days_of_given_week[int(day_idx) - 1] + '\n'
+        current_day_text += ''.join(text for _day, text in day_rows)
+        days_timetable_list.append(current_day_text)
+    return days_timetable_list
+
+
+NEXT_WEEK_WITH_CLASSES_SQL = \
+    'SELECT min(week) FROM {timetable} WHERE {name_column} = :gn AND week > :week'
+
+
+def get_next_week_with_classes(group_name: str, is_teacher: bool, week: int):
+    """First week after `week` with pairs, None if there are none till the end of the semester"""
+    timetable, name_column, _ = get_timetable_source(is_teacher)
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(sqlalchemy.text(
+                f'SET LOCAL statement_timeout = {cns.TIMETABLE_DB_TIMEOUT_MS}'))
+            # one range scan of the (name, week, ...) index instead of a query per week
+            return conn.execute(
+                sqlalchemy.text(NEXT_WEEK_WITH_CLASSES_SQL.format(
+                    timetable=timetable, name_column=name_column)),
+                gn=group_name,
+                week=week
+            ).scalar()
+    except sqlalchemy.exc.DBAPIError as e:
+        snapshot = None if is_teacher else get_timetable_snapshot(config.TIMETABLE_SNAPSHOT_PATH)
+        if snapshot is None:
+            raise
+        logger.warning(f'timetable database error, trying snapshot: {e}')
+        return next(
+            (next_week for next_week in range(week + 1, 19)
+             if snapshot.get_rows(group_name, next_week)),
+            None
+        )
+
+
+def get_user_next_week_timetable(user_id: int, week: int):
+    """(week, get_group_week_timetable of it) for the first week after `week`
+    with pairs of the user, (None, []) if there are none"""
+    user_group = get_user_group(user_id)
+    if user_group is None:
+        return None, []
+    next_week = get_next_week_with_classes(user_group.name, user_group.is_teacher, week)
+    if next_week is None:
+        return None, []
+    return next_week, get_group_week_timetable(
+        user_group.name, next_week, is_rest_week=False, is_teacher=user_group.is_teacher)
+
+
+def get_semester_week_timetable(group_name: str, semester: str, week: int) -> list:
+    """Like get_group_week_timetable, for a past semester"""
+    with get_engine().connect() as conn:
+        # a literal semester lets the planner prune the other partitions
+        rows = conn.execute(sqlalchemy.text(
+            f'SELECT * FROM {cns.TIMETABLE_NAME} '
+            'WHERE semester = :semester AND group_name = :gn AND week = :week '
+            'ORDER BY day, starttime'),
+            semester=semester,
+            gn=group_name,
+            week=week
+        ).fetchall()
+    return [
+        cns.WEEKDAY_NAMES[int(day_idx) - 1] + '\n'
+        + ''.join(map(TIMETABLE_ROW_TEMPLATE, day_rows))
+        for day_idx, day_rows in groupby(rows, key=lambda row: row['day'])
+    ]
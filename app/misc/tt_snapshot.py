@@ -0,0 +1,134 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+# File layout, all little-endian:
+#   header | index entries sorted by group name bytes | group names | rows
+# A row is ROW header followed by the utf-8 text of the rendered row.
+MAGIC = b'NSTT'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHQI')           # magic, version, reserved, generated_at, group_count
+INDEX_ENTRY = struct.Struct('<IHII')        # name_offset, name_len, rows_offset, rows_count
+ROW = struct.Struct('<BB5sH')               # week, day, endtime 'HH:MM', text_len
+
+SNAPSHOT_CHECK_INTERVAL = 30
+
+
+def normalize_time(time_str: str) -> str:
+    # '8:30' -> '08:30', so that times compare as strings
+    return time_str.strip().zfill(5)
+
+
+def write_snapshot(path: str, groups) -> int:
+    """groups: iterable of (group_name, [(week, day, endtime, text), ...]) with rows
+    sorted by week, day, starttime. Returns number of groups written."""
+    encoded_groups = sorted(
+        ((group_name.encode(), rows) for group_name, rows in groups),
+        key=lambda group: group[0]
+    )
+    index_size = HEADER.size + INDEX_ENTRY.size * len(encoded_groups)
+    names = bytearray()
+    rows_data = bytearray()
+    index = bytearray()
+    names_offset = index_size
+    names_size = sum(len(name) for name, _ in encoded_groups)
+    rows_offset = names_offset + names_size
+    for name, rows in encoded_groups:
+        index += INDEX_ENTRY.pack(
+            names_offset + len(names), len(name), rows_offset + len(rows_data), len(rows))
+        names += name
+        for week, day, endtime, text in rows:
+            text_bytes = text.encode()
+            rows_data += ROW.pack(week, day, normalize_time(endtime).encode(), len(text_bytes))
+            rows_data += text_bytes
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, int(time.time()), len(encoded_groups)))
+        f.write(index)
+        f.write(names)
+        f.write(rows_data)
+    # readers that already mapped the old file keep using it
+    os.replace(tmp_path, path)
+    return len(encoded_groups)
+
+
+class TimetableSnapshot:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.file_stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.generated_at, self.group_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a timetable snapshot of version {FORMAT_VERSION}')
+
+    def _find_group(self, group_name: str):
+        key = group_name.encode()
+        low, high = 0, self.group_count
+        while low < high:
+            middle = (low + high) // 2
+            name_offset, name_len, rows_offset, rows_count = INDEX_ENTRY.unpack_from(
+                self._mmap, HEADER.size + middle * INDEX_ENTRY.size)
+            name = self._mmap[name_offset:name_offset + name_len]
+            if name == key:
+                return rows_offset, rows_count
+            if name < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def get_rows(self, group_name: str, week: int, day: int = None) -> list:
+        """[(day, endtime, text), ...] of the group for the week, and day if given"""
+        group = self._find_group(group_name)
+        if group is None:
+            return []
+        offset, rows_count = group
+        result = []
+        for _ in range(rows_count):
+            row_week, row_day, endtime, text_len = ROW.unpack_from(self._mmap, offset)
+            offset += ROW.size
+            if row_week > week:
+                break
+            if row_week == week and (day is None or row_day == day):
+                result.append((
+                    row_day,
+                    endtime.decode(),
+                    self._mmap[offset:offset + text_len].decode()
+                ))
+            offset += text_len
+        return result
+
+
+_snapshot = None
+_snapshot_checked_at = 0.0
+_snapshot_lock = threading.Lock()
+
+
+def invalidate_timetable_snapshot() -> None:
+    # next get_timetable_snapshot checks the file right away
+    global _snapshot_checked_at
+    with _snapshot_lock:
+        _snapshot_checked_at = 0.0
+
+
+def get_timetable_snapshot(path: str):
+    """Snapshot mapped from path, reopened when the file is replaced. None if missing."""
+    global _snapshot, _snapshot_checked_at
+    with _snapshot_lock:
+        now = time.monotonic()
+        if _snapshot is not None and now - _snapshot_checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return _snapshot
+        _snapshot_checked_at = now
+        try:
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            _snapshot = None
+            return None
+        if _snapshot is None \
+                or (file_stat.st_ino, file_stat.st_mtime_ns) \
+                != (_snapshot.file_stat.st_ino, _snapshot.file_stat.st_mtime_ns):
+            _snapshot = TimetableSnapshot(path)
+        return _snapshot
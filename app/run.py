@@ -1,26 +1,54 @@
 import datetime
-import locale
+import hashlib
+import io
 import logging
-import os
-import re
-import tempfile
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
-from html import unescape
+from html import escape
 from subprocess import call
 
-import pandas
 import sqlalchemy
 from rapidfuzz import fuzz, process
 from telegram import (CallbackQuery, ForceReply, InlineKeyboardButton,
                       InlineKeyboardMarkup, ReplyKeyboardMarkup, Update,
                       error, Message)
 from telegram.ext import (CallbackContext, CallbackQueryHandler,
-                          CommandHandler, ConversationHandler, Filters,
-                          MessageHandler, PicklePersistence, Updater)
+                          CommandHandler, ConversationHandler,
+                          DispatcherHandlerStop, Filters, MessageHandler,
+                          PicklePersistence, TypeHandler, Updater)
+from telegram.utils.request import Request
 from transliterate import translit
 
 import misc.config as config
 import misc.constants as cns
+import misc.log as log
+import misc.metrics as metrics
+import misc.profiling as profiling
+import misc.pools as pools
+import misc.rate_limit as rate_limit
+from misc.at_jobs import create_at_job, get_offset_date
+from misc.cache import LRUCache
+from misc.db import get_engine
+from misc.dedup import RecentIds
+from misc.delivery import DeliveryBot
+from misc.news import (decode_news_key, encode_news_key, get_news_from_db,
+                       get_news_page, news_cache, search_news_in_db)
+from misc.notify import (DELIVERY_QUEUED, NEWS_INSERTED, TIMETABLE_RELOADED,
+                         USER_CHANGED, NotifyListener, notify)
+from misc.outbox import drain_outbox
+from misc.pair_index import get_pair_index, pair_index_cache
+from misc.prewarm import PrewarmScheduler
+from misc.room_occupancy import RoomOccupancy, occupancy_from_bytes
+from misc.study_calendar import (get_current_week, get_days_by_week,
+                                 get_local_now, get_previous_semester,
+                                 get_semester, get_study_week, set_ru_locale)
+from misc.timetable import (UserGroup, get_user_day_timetable, get_user_group,
+                            get_semester_week_timetable,
+                            get_user_next_week_timetable,
+                            get_user_week_timetable, prerendered_cache,
+                            user_group_cache)
+from misc.tt_snapshot import invalidate_timetable_snapshot
 
 
 @dataclass
@@ -30,74 +58,69 @@ class NotifyMode:
 
 
 menu_keyboard_markup = ReplyKeyboardMarkup(
-    cns.cns.MENU_BUTTONS,
+    cns.MENU_BUTTONS,
     one_time_keyboard=False,
     resize_keyboard=True
 )
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.WARNING
-)
-
-# for datetime format
-locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
-
 logger = logging.getLogger(__name__)
 
 days_dict = {1: 'Пн', 2: 'Вт', 3: 'Ср', 4: 'Чт', 5: 'Пт', 6: 'Сб', 7: 'Вс'}
 
-engine = sqlalchemy.create_engine(config.db_connection_string)
+engine = get_engine()
 
 settings_state_dict = {}
 
 # Сообщение, которое нам нужно удалить что бы в чатике было красиво.
 last_unused_messages_dict = {}
 
+teacher_names_cache = LRUCache('teacher_names', 1, ttl=cns.TEACHER_NAMES_TTL)
 
-def TIMETABLE_ROW_TEMPLATE(row) -> str:
-    return (
-        f"[{row['pair_number']}] {row['starttime']}-{row['endtime']} "
-        f"{'[' + row['tsw_name'] + '] ' if row['tsw_name'] is not None else ''} "
-        f"{row['classname']} {row['rooms'] if row['rooms'] is not None else ''} "
-        f"{row['teacher1']} {row['teacher2']}\n"
-    )
+room_occupancy_cache = LRUCache('room_occupancy', 1, ttl=cns.ROOM_OCCUPANCY_TTL)
+
+# Telegram redelivers updates when the webhook answers slowly
+recent_update_ids = RecentIds(cns.UPDATE_DEDUP_WINDOW)
+metrics.register_stats_source('update_dedup', recent_update_ids.stats)
+
+# (chat_id, message_id) -> hash of the last text and markup we put there
+last_message_content_dict = OrderedDict()
+last_message_content_lock = threading.Lock()
 
 
 def start(update: Update, context: CallbackContext):
-    context.dispatcher.run_async(
+    pools.submit(
+        pools.TELEGRAM_IO,
         update.message.reply_text,
         text='Привет. Я бот-помощник студента НГТУ \n'
              'Отправьте /cancel если хотите прервать общение.\n\n'
              'Введите вашу группу',
-        reply_markup=ForceReply(),
-        update=update
+        reply_markup=ForceReply()
     )
 
-    return cns.cns.CLAIM_USER_GROUP_HANDLER
+    return cns.CLAIM_USER_GROUP_HANDLER
 
 
 def timetable_markup(chosen_time: str) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton(
             "Расписание на текущий день "
-            f"{'✅' if chosen_time == cns.cns.DAY_SCHEDULE else ''}",
-            callback_data=cns.cns.DAY_SCHEDULE
+            f"{'✅' if chosen_time == cns.DAY_SCHEDULE else ''}",
+            callback_data=cns.DAY_SCHEDULE
         )],
         [InlineKeyboardButton(
             "Расписание на оставшуюся неделю "
-            f"{'✅' if chosen_time == cns.cns.WEEK_SCHEDULE else ''}",
-            callback_data=cns.cns.WEEK_SCHEDULE
+            f"{'✅' if chosen_time == cns.WEEK_SCHEDULE else ''}",
+            callback_data=cns.WEEK_SCHEDULE
         )],
         [InlineKeyboardButton(
             "Расписание на выбранную неделю "
-            f"{'✅' if chosen_time == cns.cns.SPECIFIC_WEEK_SCHEDULE else ''}",
-            callback_data=cns.cns.SPECIFIC_WEEK_SCHEDULE
+            f"{'✅' if chosen_time == cns.SPECIFIC_WEEK_SCHEDULE else ''}",
+            callback_data=cns.SPECIFIC_WEEK_SCHEDULE
         )]]
     return InlineKeyboardMarkup(keyboard)
 
 
-def news_markup(chosen_news_interval: str) -> InlineKeyboardMarkup:
+def news_markup(chosen_news_interval: str, older_news_key=None) -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton(
             "Новости на текущий день "
@@ -115,6 +138,11 @@ def news_markup(chosen_news_interval: str) -> InlineKeyboardMarkup:
             callback_data=cns.SPECIFIC_DATE_NEWS
         )]
     ]
+    if older_news_key is not None:
+        keyboard.append([InlineKeyboardButton(
+            'Более старые новости →',
+            callback_data=f'{cns.OLDER_NEWS_PREFIX}{encode_news_key(older_news_key)}'
+        )])
     return InlineKeyboardMarkup(keyboard)
 
 
@@ -144,7 +172,7 @@ def schedule_notification_settings_markup() -> InlineKeyboardMarkup:
         )],
         [InlineKeyboardButton(
             "Выбрать времени оповещения относительно первой пары",
-            callback_data=cns.cns.SPECIFY_SEND_MSG_TIME_OFFSET
+            callback_data=cns.SPECIFY_SEND_MSG_TIME_OFFSET
         )],
         [InlineKeyboardButton(
             "Назад",
@@ -215,13 +243,43 @@ def weeks_num_markup() -> InlineKeyboardMarkup:
 # database and telegram server
 
 
-def edit_message_text_and_markup_async(query, message_args, markup_args):
+def get_message_content_hash(message_args: dict) -> str:
+    markup = message_args.get('reply_markup')
+    content = '\x00'.join((
+        str(message_args.get('text')),
+        markup.to_json() if markup is not None else '',
+        str(message_args.get('parse_mode')),
+        str(message_args.get('disable_web_page_preview'))
+    ))
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+def edit_message_text_and_markup_async(query, message_args, markup_args=None):
+    # Text and markup go in one editMessageText call, and we don't call
+    # the api at all if the message already looks like this
+    message_args = {**message_args, **(markup_args or {})}
+    key = (query.message.chat_id, query.message.message_id)
+    content_hash = get_message_content_hash(message_args)
+    with last_message_content_lock:
+        if last_message_content_dict.get(key) == content_hash:
+            metrics.inc('edit_message_skipped')
+            return
     try:
         query.edit_message_text(**message_args)
-        query.edit_message_reply_markup(**markup_args)
-    except error.BadRequest:
-        # Catch this exception when we delete inline keyboard
-        pass
+        metrics.inc('edit_message_sent')
+    except error.BadRequest as e:
+        if 'message is not modified' not in str(e).lower():
+            # Catch this exception when we delete inline keyboard
+            metrics.inc('edit_message_failed')
+            with last_message_content_lock:
+                last_message_content_dict.pop(key, None)
+            return
+        metrics.inc('edit_message_not_modified')
+    with last_message_content_lock:
+        last_message_content_dict[key] = content_hash
+        last_message_content_dict.move_to_end(key)
+        while len(last_message_content_dict) > cns.EDITED_MESSAGES_CACHE_SIZE:
+            last_message_content_dict.popitem(last=False)
 
 
 def reply_and_delete_message_async(message: Message, message_args) -> None:
@@ -239,28 +297,27 @@ def get_true_groups_name(input: str, group_names: list) -> list:
     # return list(map(list, zip(*score)))
 
 
-def get_first_study_day_date() -> datetime.date:
-    if datetime.date.today().month < 8 and datetime.date.today().month > 2:
-        return datetime.date(datetime.date.today().year, 9, 1)
-    else:
-        return datetime.date(datetime.date.today().year, 9, 1)
+def get_teacher_key(teacher_name: str) -> str:
+    # Teacher names don't fit into 64 bytes of callback_data, their hashes do
+    return hashlib.md5(teacher_name.encode()).hexdigest()[:16]
+
+
+def load_teacher_names(_key) -> dict:
+    with engine.connect() as conn:
+        result = conn.execute(sqlalchemy.text(
+            "SELECT DISTINCT teacher_name "
+            f"FROM {cns.TEACHER_TIMETABLE_WEEK_VIEW_NAME}"
+        ))
+        return {get_teacher_key(row['teacher_name']): row['teacher_name'] for row in result}
 
 
-def get_days_by_week(week_to_check: int) -> list:
-    given_week_rnd_day = get_first_study_day_date(
-    ) + datetime.timedelta(weeks=week_to_check - 1)
-    dates = [given_week_rnd_day + datetime.timedelta(days=i) for i in range(
-        0 - given_week_rnd_day.weekday(), 7 - given_week_rnd_day.weekday())]
-    # days = [datetime.datetime.strptime(str(year) + "-" + str(week - 1) 
-    # + "-" + str(x), "%Y-%W-%u") for x in range(1, 8)]
-    dates_strings = [datetime.date.strftime(
-        day, '%a. %d %B %Y') for day in dates]
-    return dates_strings
+def get_teacher_names() -> list:
+    return list(teacher_names_cache.get_or_load('teacher_names', load_teacher_names).values())
 
 
-def get_current_week() -> int:
-    return datetime.date.today().isocalendar()[1] \
-        - get_first_study_day_date().isocalendar()[1] + 1
+def get_teacher_by_key(teacher_key: str):
+    """Teacher name of get_teacher_key, None if there is no such teacher anymore"""
+    return teacher_names_cache.get_or_load('teacher_names', load_teacher_names).get(teacher_key)
 
 
 # the name of this function is nod to history of creating this bot
@@ -277,12 +334,14 @@ def init_user(update: Update, context: CallbackContext):
                 if _ == 100.0:
                     with engine.begin() as conn:
                         conn.execute(sqlalchemy.text(
-                            "INSERT INTO users.usergroup (user_id, group_name) "
-                            "VALUES (:u_id, :gn) ON CONFLICT (user_id) DO UPDATE "
-                            "SET group_name = :gn"),
+                            "INSERT INTO users.usergroup (user_id, group_name, is_teacher) "
+                            "VALUES (:u_id, :gn, false) ON CONFLICT (user_id) DO UPDATE "
+                            "SET (group_name, is_teacher) = (:gn, false)"),
                             u_id=update.message.from_user.id,
                             gn=group
                             )
+                        notify(conn, USER_CHANGED, update.message.from_user.id)
+                    user_group_cache.set(update.message.from_user.id, UserGroup(group))
                     # We resend message with markup,
                     # because callback_query can't send menu keyboard as markup
                     update.message.reply_text(
@@ -292,16 +351,33 @@ def init_user(update: Update, context: CallbackContext):
                     return ConversationHandler.END
                 keyboard.append(
                     [InlineKeyboardButton(group, callback_data=group)])
+            # Group names always have digits, surnames don't
+            if not any(char.isdigit() for char in update.message.text):
+                teachers = [
+                    teacher for teacher, _ in process.extract(
+                        update.message.text,
+                        get_teacher_names(),
+                        scorer=fuzz.WRatio,
+                        limit=cns.TEACHER_SEARCH_LIMIT
+                    )
+                ]
+                for teacher in teachers:
+                    keyboard.append([InlineKeyboardButton(
+                        teacher,
+                        callback_data=f'{cns.TEACHER_CALLBACK_PREFIX}{get_teacher_key(teacher)}'
+                    )])
             keyboard.append([InlineKeyboardButton(
                 'Другая группа', callback_data='Другая группа')])
-            context.dispatcher.run_async(
+            pools.submit(
+                pools.TELEGRAM_IO,
                 update.message.reply_text,
                 text='Выберите группу',
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                update=update
+                reply_markup=InlineKeyboardMarkup(keyboard)
             )
             return cns.SET_USER_GROUP_HANDLER
 
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error(str(e), exc_info=True)
 
@@ -314,37 +390,55 @@ def select_group(update: Update, context: CallbackContext):
         query.message.delete()
         change_user_group(query, context)
         return cns.CLAIM_USER_GROUP_HANDLER
+    if query.data.startswith(cns.TEACHER_CALLBACK_PREFIX):
+        teacher_name = get_teacher_by_key(query.data[len(cns.TEACHER_CALLBACK_PREFIX):])
+        if teacher_name is None:
+            # the timetable was reloaded without this teacher since the search
+            pools.submit(
+                pools.TELEGRAM_IO,
+                edit_message_text_and_markup_async,
+                query,
+                {'text': 'Преподаватель не найден, введите фамилию еще раз'}
+            )
+            return cns.CLAIM_USER_GROUP_HANDLER
+        user_group = UserGroup(teacher_name, True)
+        greeting = f'Ваше расписание: {user_group.name}\n'
+    else:
+        user_group = UserGroup(query.data)
+        greeting = f'Ваша группа {user_group.name}!\nПоздравляю вас\n'
     try:
         with engine.begin() as conn:
             conn.execute(sqlalchemy.text(
-                "INSERT INTO users.usergroup (user_id, group_name) " +
-                "VALUES (:u_id, :gn) " +
+                "INSERT INTO users.usergroup (user_id, group_name, is_teacher) " +
+                "VALUES (:u_id, :gn, :is_teacher) " +
                 "ON CONFLICT (user_id) DO UPDATE " +
-                "SET group_name = :gn"),
+                "SET (group_name, is_teacher) = (:gn, :is_teacher)"),
                 u_id=query.from_user.id,
-                gn=query.data
+                gn=user_group.name,
+                is_teacher=user_group.is_teacher
             )
+            notify(conn, USER_CHANGED, query.from_user.id)
+        user_group_cache.set(query.from_user.id, user_group)
         # We resend message with markup,
         # because callback_query can't send menu keyboard as markup
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             reply_and_delete_message_async,
             query.message,
             {
-                'text': f'Ваша группа {update.callback_query.data}!\n' +
-                'Поздравляю вас\n',
+                'text': greeting,
                 'reply_markup': menu_keyboard_markup
-            },
-            update=update
+            }
         )
     except sqlalchemy.exc.IntegrityError:   # Ignored, becasue of INSERT ON CONFLICT
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             reply_and_delete_message_async,
             query.message,
             {
                 'text': 'Вы уже есть тут, шо вам еще надо?',
                 'reply_markup': menu_keyboard_markup
-            },
-            update=update
+            }
         )
     fallback(update, context)
     return ConversationHandler.END
@@ -363,103 +457,6 @@ def cancel(update: Update, context: CallbackContext):
     return cns.CLAIM_USER_GROUP_HANDLER
 
 
-def get_user_day_timetable(user_id: int):
-    with engine.connect() as conn:
-        current_week = get_current_week()
-        if current_week < 19:
-            week_check_str = 'AND ((is_odd = -1 AND week18 = True) OR (is_odd = 0))'\
-                if current_week == 18 \
-                else f'AND week{current_week} = true'
-
-            result = conn.execute(sqlalchemy.text(
-                "SELECT * "
-                f"FROM {cns.TIMETABLE_NAME} "
-                "WHERE group_name IN "
-                "   (SELECT group_name "
-                "   FROM users.usergroup "
-                "   WHERE user_id = :uid "
-                "   LIMIT 1"
-                ") "
-                "AND day = (select extract(isodow from now())) "
-                f"{week_check_str} "
-                "ORDER BY starttime"),
-                uid=user_id
-            )
-            if result.rowcount == 0:
-                return None
-            else:
-                return ''.join(map(TIMETABLE_ROW_TEMPLATE, result))
-
-
-def get_user_week_timetable(user_id: int, week_to_check, is_rest_week, context_async=None, update_async=None):
-    rest_week_sql = f'AND ((day = EXTRACT(isodow from {config.SQL_NOW}) '\
-                    f'AND endtime > to_char({config.SQL_NOW}, \'HH24:MI\')) '\
-                    f'OR (day>EXTRACT(isodow from {config.SQL_NOW})))'
-
-    week_check_str = 'AND ((is_odd = -1 AND week18 = True) OR (is_odd = 0))'\
-        if week_to_check == 18\
-        else\
-        f'AND week{week_to_check} = true'
-
-    if context_async is None and update_async is None:
-        days_of_given_week = get_days_by_week(week_to_check)
-        with engine.connect() as conn:
-            result = pandas.read_sql(sqlalchemy.text(
-                f"SELECT * FROM {cns.TIMETABLE_NAME} "
-                "WHERE group_name IN ("
-                "   SELECT group_name"
-                "   FROM users.usergroup"
-                "   WHERE user_id = :uid "
-                "   LIMIT 1) "
-                f"{week_check_str} "
-                f"{rest_week_sql if is_rest_week == True else ''} "
-                "ORDER BY day, starttime"),
-                conn,
-                params={'uid': user_id}
-            )
-            days_timetable_list = []
-            days = result[['day']].groupby('day').count()
-            for day_idx in days.index:
-                current_day_text = ""
-                current_day_timetable = result[result['day'] == int(day_idx)]
-                current_day_text += days_of_given_week[int(day_idx) - 1] + '\n'
-                for _index, row in current_day_timetable.iterrows():
-                    current_day_text += TIMETABLE_ROW_TEMPLATE(row)
-                days_timetable_list.append(current_day_text)
-        return days_timetable_list
-    else:
-        days_of_given_week = context_async.dispatcher.run_async(
-            get_days_by_week,
-            week_to_check,
-            update=update_async
-        )
-        with engine.connect() as conn:
-            result = pandas.read_sql(sqlalchemy.text(
-                f"SELECT * FROM {cns.TIMETABLE_NAME} "
-                "WHERE group_name IN ("
-                "   SELECT group_name "
-                "   FROM users.usergroup "
-                "   WHERE user_id = :uid "
-                "   LIMIT 1) "
-                f"{week_check_str} "
-                f"{rest_week_sql if is_rest_week == True else ''} "
-                "ORDER BY day, starttime"),
-                conn,
-                params={'uid': user_id}
-            )
-        days_timetable_list = []
-        days = result[['day']].groupby('day').count()
-        for day_idx in days.index:
-            current_day_text = ""
-            current_day_timetable = result[result['day'] == int(day_idx)]
-            current_day_text += days_of_given_week.result()[
-                int(day_idx) - 1] + '\n'
-            for _index, row in current_day_timetable.iterrows():
-                current_day_text += TIMETABLE_ROW_TEMPLATE(row)
-            days_timetable_list.append(current_day_text)
-        return days_timetable_list
-
-
 def proceed_timetable(update: Update, context: CallbackContext) -> str:
     user_timetable = get_user_day_timetable(update.message.from_user.id)
     update.message.reply_text(
@@ -470,73 +467,130 @@ def proceed_timetable(update: Update, context: CallbackContext) -> str:
     return cns.SCHEDULE_MENU_HANDLER
 
 
-def get_news_from_db(news_interval: str, date: datetime.date = None) -> str:
-    news_text = ''
-    with engine.begin() as conn:
-        news_query = conn.execute(
-            sqlalchemy.text(
-                'SELECT title, url, shorttext, news_date '
-                'FROM test.news '
-                + (' WHERE EXTRACT(DAY FROM news_date) = EXTRACT(DAY FROM now()) '
-                    if news_interval == cns.DAY_NEWS
-                    else f'WHERE DATE(news_date) = \'{date}\' '
-                    if news_interval == cns.SPECIFIC_DATE_NEWS
-                    else ''
-                   )
-                + ' ORDER BY news_date DESC '
-                + (' LIMIT 5'
-                    if news_interval == cns.LAST_FIVE_NEWS
-                    else ('LIMIT ' + str(news_interval))
-                    if isinstance(news_interval, int)
-                    else '')
-            )
-        )
-        for row in news_query:
-            news_text += f"{row['title']}\n" \
-                         + (('[' + remove_html_tags(unescape(row['shorttext'])) + ']\n')
-                            if row['shorttext'] is not None
-                            else ''
-                            ) \
-                         + row['url'] + '\n' + row['news_date'].strftime('%c') + '\n\n'
-    return news_text
+def news_search_markup(page: int, has_next_page: bool) -> InlineKeyboardMarkup:
+    keyboard = []
+    if page > 0:
+        keyboard.append(InlineKeyboardButton(
+            '← Назад', callback_data=f'{cns.NEWS_SEARCH_PAGE_PREFIX}{page - 1}'))
+    if has_next_page:
+        keyboard.append(InlineKeyboardButton(
+            'Дальше →', callback_data=f'{cns.NEWS_SEARCH_PAGE_PREFIX}{page + 1}'))
+    return InlineKeyboardMarkup([keyboard])
+
+
+def get_news_search_page_text(search_query: str, page: int):
+    news_text, has_next_page = search_news_in_db(search_query, page)
+    if news_text is None:
+        return 'Поиск занял слишком много времени, попробуйте уточнить запрос', False
+    if not news_text:
+        return f'По запросу «{escape(search_query)}» ничего не нашлось', False
+    return f'Поиск: {escape(search_query)}, страница {page + 1}\n\n{news_text}', has_next_page
+
+
+def proceed_news_search(update: Update, context: CallbackContext):
+    search_query = ' '.join(context.args)
+    if not search_query:
+        update.message.reply_text(text='Использование: /search <запрос>')
+        return
+    context.user_data['news_search_query'] = search_query
+    text, has_next_page = get_news_search_page_text(search_query, 0)
+    update.message.reply_text(
+        text=text,
+        reply_markup=news_search_markup(0, has_next_page),
+        parse_mode='HTML',
+        disable_web_page_preview=True
+    )
+
+
+def news_search_page(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    search_query = context.user_data.get('news_search_query')
+    if search_query is None:
+        return
+    page = int(query.data[len(cns.NEWS_SEARCH_PAGE_PREFIX):])
+    text, has_next_page = get_news_search_page_text(search_query, page)
+    pools.submit(
+        pools.TELEGRAM_IO,
+        edit_message_text_and_markup_async,
+        query,
+        {'text': text, 'parse_mode': 'HTML', 'disable_web_page_preview': True},
+        {'reply_markup': news_search_markup(page, has_next_page)}
+    )
+
+
+def older_news_page(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    news_text, older_news_key = get_news_page(
+        decode_news_key(query.data[len(cns.OLDER_NEWS_PREFIX):]))
+    pools.submit(
+        pools.TELEGRAM_IO,
+        edit_message_text_and_markup_async,
+        query,
+        {'text': news_text or 'А новостей-то нету :(',
+         'parse_mode': 'HTML', 'disable_web_page_preview': True},
+        {'reply_markup': news_markup(None, older_news_key)}
+    )
 
 
 def proceed_news(update: Update, context: CallbackContext) -> str:
+    news_text, older_news_key = get_news_page()
     update.message.reply_text(
-        text=get_news_from_db(cns.LAST_FIVE_NEWS),
-        reply_markup=news_markup(cns.LAST_FIVE_NEWS),
+        text=news_text,
+        reply_markup=news_markup(cns.LAST_FIVE_NEWS, older_news_key),
         parse_mode='HTML',
         disable_web_page_preview=True
     )
     return cns.NEWS_MENU_HANDLER
 
 
+def edit_news_message_async(query, chosen_news_interval: str) -> None:
+    # Runs in the DB_READ pool and hands the edit over to TELEGRAM_IO
+    if chosen_news_interval == cns.LAST_FIVE_NEWS:
+        news_text, older_news_key = get_news_page()
+    else:
+        news_text, older_news_key = get_news_from_db(chosen_news_interval), None
+    pools.submit(
+        pools.TELEGRAM_IO,
+        edit_message_text_and_markup_async,
+        query,
+        {'text': 'А новостей-то нету :(' if not news_text
+         else news_text, 'parse_mode': 'HTML', 'disable_web_page_preview': True},
+        {'reply_markup': news_markup(chosen_news_interval, older_news_key)}
+    )
+
+
+def reply_date_news_async(message, user_date: datetime.date) -> None:
+    # Runs in the DB_READ pool and hands the reply over to TELEGRAM_IO
+    news_text = get_news_from_db(cns.SPECIFIC_DATE_NEWS, date=user_date)
+    pools.submit(
+        pools.TELEGRAM_IO,
+        reply_and_delete_message_async,
+        message,
+        {
+            'text': news_text if news_text else cns.EMPTY_NEWS,
+            'reply_markup': news_markup(cns.SPECIFIC_DATE_NEWS),
+            'parse_mode': 'HTML',
+            'disable_web_page_preview': True
+        }
+    )
+
+
 def news_button_switch(update: Update, context: CallbackContext) -> str:
     query = update.callback_query
     chosen_news_interval = query.data
     query.answer()
 
     if chosen_news_interval == cns.LAST_FIVE_NEWS or chosen_news_interval == cns.DAY_NEWS:
-        news_text_task = context.dispatcher.run_async(
-            get_news_from_db,
-            chosen_news_interval,
-            update=update
-        )
-        context.dispatcher.run_async(
-            edit_message_text_and_markup_async,
-            query,
-            {'text': 'А новостей-то нету :(' if not news_text_task.result(
-            ) else news_text_task.result(), 'parse_mode': 'HTML', 'disable_web_page_preview': True},
-            {'reply_markup': news_markup(chosen_news_interval)},
-            update=update
-        )
+        pools.submit(pools.DB_READ, edit_news_message_async, query, chosen_news_interval)
     elif chosen_news_interval == cns.SPECIFIC_DATE_NEWS:
-        query.edit_message_text(
-            text='Введите желаемую дату в формате:\nDD.MM.YYYY')
-        query.edit_message_reply_markup(
-            reply_markup=InlineKeyboardMarkup(
+        edit_message_text_and_markup_async(
+            query,
+            {'text': 'Введите желаемую дату в формате:\nDD.MM.YYYY'},
+            {'reply_markup': InlineKeyboardMarkup(
                 [[InlineKeyboardButton("Назад", callback_data=cns.LAST_FIVE_NEWS)]]
-            )
+            )}
         )
         last_unused_messages_dict[query.from_user.id] = query.message.message_id
         return cns.SPECIFIC_DATE_NEWS_HANDLER
@@ -547,24 +601,12 @@ def proceed_date_news(update: Update, context: CallbackContext) -> None:
     try:
         user_date = datetime.datetime.strptime(
             update.message.text, '%d.%m.%Y').date()
-        news_text_task = context.dispatcher.run_async(
-            get_news_from_db, cns.SPECIFIC_DATE_NEWS, update=update, date=user_date)
         global last_unused_messages_dict
 
         if update.message.chat_id in last_unused_messages_dict:     # To avoid crash after restart of app :)
             update.message.bot.delete_message(
                 update.message.chat_id, last_unused_messages_dict[update.message.from_user.id])
-        context.dispatcher.run_async(
-            reply_and_delete_message_async,
-            update.message,
-            {
-                'text': news_text_task.result() if news_text_task.result() else cns.EMPTY_NEWS,
-                'reply_markup': news_markup(cns.SPECIFIC_DATE_NEWS),
-                'parse_mode': 'HTML',
-                'disable_web_page_preview': True
-            },
-            update=update
-        )
+        pools.submit(pools.DB_READ, reply_date_news_async, update.message, user_date)
 
     except ValueError:
         if update.message.text in cns.PLAIN_MENU_BUTTONS:
@@ -615,13 +657,13 @@ def get_user_notify_mode(user_id: int) -> NotifyMode:
 
 
 def proceed_settings_start(update: Update, context: CallbackContext) -> str:
-    context.dispatcher.run_async(
+    pools.submit(
+        pools.TELEGRAM_IO,
         update.message.reply_text,
         text='Настройки подписок',
         # IN THE FUTETRE, CHANGE NUM IN MARKUP AS SELECT FROM DB GET USER RECIEVING MESSAGES MODE
         reply_markup=settings_markup(
-            get_user_notify_mode(update.message.from_user.id)),
-        update=update
+            get_user_notify_mode(update.message.from_user.id))
     )
     return cns.START_SETTINGS_HANDLER
 
@@ -629,12 +671,10 @@ def proceed_settings_start(update: Update, context: CallbackContext) -> str:
 def db_set_specific_time_schedule_settings_async(
         engine: sqlalchemy.engine.Engine,
         time,
-        user_id,
-        update_async, 
-        context_async) -> sqlalchemy.engine.CursorResult:
+        user_id) -> sqlalchemy.engine.CursorResult:
     with engine.begin() as conn:
-        job_id = context_async.dispatcher.run_async(
-            create_at_job, user_id, time, mode=cns.ENABLED_SCHEDULE_NOTIFICATION, update=update_async)
+        # already in the db_write pool, waiting for a nested job there could deadlock
+        job_id = create_at_job(user_id, time, mode=cns.ENABLED_SCHEDULE_NOTIFICATION)
         user_time = datetime.datetime.strptime(time, '%H:%M')
         group_names_query = conn.execute(sqlalchemy.text(
             "SELECT job_id FROM users.usergroup WHERE user_id=:uid AND job_id IS NOT NULL"), uid=user_id)
@@ -647,29 +687,27 @@ def db_set_specific_time_schedule_settings_async(
             " = (:smt,:jid, NULL) WHERE user_id=:uid"),
             uid=user_id,
             smt=user_time.time(),
-            jid=int(job_id.result())
+            jid=int(job_id)
         )
 
 
 def proceed_schedule_specific_time_settings(update: Update, context: CallbackContext) -> str:
     try:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.DB_WRITE,
             db_set_specific_time_schedule_settings_async,
             engine,
             update.message.text,
-            update.message.from_user.id,
-            update=update,
-            update_async=update,
-            context_async=context
+            update.message.from_user.id
         )
         global settings_state_dict
         settings_state_dict[update.message.from_user.id].schedule = cns.ENABLED_SCHEDULE_NOTIFICATION
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             update.message.reply_text,
             text=f'Теперь вы будете ежедневно оповещаться в {update.message.text}',
             reply_markup=settings_markup(
-                get_user_notify_mode(update.message.from_user.id)),
-            update=update
+                get_user_notify_mode(update.message.from_user.id))
         )
         return cns.START_SETTINGS_HANDLER
 
@@ -679,6 +717,8 @@ def proceed_schedule_specific_time_settings(update: Update, context: CallbackCon
             return ConversationHandler.END
         update.message.delete()
         return cns.OFFSET_TIME_SETTINGS_HANDLER
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error(str(e), exc_info=True)
 
@@ -710,21 +750,21 @@ def db_set_specific_time_news_settings(engine: sqlalchemy.engine.Engine, time, u
 
 def proceed_news_specific_time_settings(update: Update, context: CallbackContext):
     try:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.DB_WRITE,
             db_set_specific_time_news_settings,
             engine,
             update.message.text,
-            update.message.from_user.id,
-            update=update
+            update.message.from_user.id
         )
         global settings_state_dict
         settings_state_dict[update.message.from_user.id].news = cns.ENABLED_NEWS_NOTIFICATION
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             update.message.reply_text,
             text=f'Теперь вы будете ежедневно оповещаться в {update.message.text}',
             reply_markup=settings_markup(
-                get_user_notify_mode(update.message.from_user.id)),
-            update=update
+                get_user_notify_mode(update.message.from_user.id))
         )
 
         return cns.START_SETTINGS_HANDLER
@@ -735,36 +775,12 @@ def proceed_news_specific_time_settings(update: Update, context: CallbackContext
             return ConversationHandler.END
         update.message.delete()
         return cns.OFFSET_TIME_SETTINGS_HANDLER
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error(str(e), exc_info=True)
 
 
-def get_offset_date(user_id: int, input_time) -> str:
-    try:
-        current_study_week = get_current_week()
-        with engine.begin() as conn:
-            date_string = ''
-            week_of_year = datetime.date.today().isocalendar()[1]
-            file = open('./misc/sql/select/next_first_pair.sql')
-            next_first_pair_query = conn.execute(sqlalchemy.text(
-                file.read()), uid=user_id, week_num=current_study_week)
-            if next_first_pair_query.rowcount != 0:
-                tmp = next_first_pair_query.fetchone()
-                week_of_year = datetime.date.today().isocalendar()[1]
-                week = week_of_year - current_study_week + tmp['week']
-                first_pair_time = datetime.datetime.strptime(
-                    tmp['starttime'], '%H:%M')
-                notify_time = datetime.datetime.min + \
-                    (first_pair_time - input_time)
-                actual_date = datetime.datetime.fromisocalendar(datetime.date.today().isocalendar(
-                )[0], week, tmp['day']).replace(hour=notify_time.hour, minute=notify_time.minute)
-                date_string = actual_date.strftime('%H:%M %d.%m.%Y')
-    except Exception as e:
-        logger.error(str(e), exc_info=True)
-        pass
-    return date_string
-
-
 def db_set_offset_time_settings(engine: sqlalchemy.engine.Engine, date_string: str, user_time: str, user_id: int):
     with engine.begin() as conn:
         job_id = create_at_job(user_id, date_string,
@@ -798,13 +814,13 @@ def proceed_offset_time_settings(update: Update, context: CallbackContext):
             user_id=update.message.from_user.id,
             input_time=user_time
         )
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.DB_WRITE,
             db_set_offset_time_settings,
             engine,
             date_string,
             user_time,
-            update.message.from_user.id,
-            update=update
+            update.message.from_user.id
         )
         
         global settings_state_dict
@@ -812,12 +828,12 @@ def proceed_offset_time_settings(update: Update, context: CallbackContext):
             update.message.from_user.id
         ].schedule = cns.ENABLED_SCHEDULE_NOTIFICATION
 
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             update.message.reply_text,
             text=f'Теперь вы будете ежедневно оповещаться за {update.message.text} до пары',
             reply_markup=settings_markup(
-                get_user_notify_mode(update.message.from_user.id)),
-            update=update
+                get_user_notify_mode(update.message.from_user.id))
         )
         return cns.START_SETTINGS_HANDLER
     except ValueError:
@@ -826,27 +842,12 @@ def proceed_offset_time_settings(update: Update, context: CallbackContext):
             return ConversationHandler.END
         update.message.delete()
         return cns.OFFSET_TIME_SETTINGS_HANDLER
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error('proceed_offset!!!! ' + str(e), exc_info=True)
 
 
-def switch_files(mode: str) -> str:
-    return 'send_schedule_daily.py' if mode == cns.ENABLED_SCHEDULE_NOTIFICATION else 'send_news_daily.py'
-
-
-def create_at_job(user_id: int, time: str, mode=cns.ENABLED_SCHEDULE_NOTIFICATION) -> str:
-    job_id = None
-    tmp = tempfile.NamedTemporaryFile(mode='r+t')
-    cmd = f'echo \"python3 {os.getcwd()}/{switch_files(mode)} {user_id}\" | at -m {time}'
-    call(cmd, shell=True, stderr=tmp)
-    tmp.seek(0)
-    for line in tmp:
-        if 'job' in line:
-            job_id = line.split()[1]
-    tmp.close()
-    return job_id
-
-
 def db_cancel_schedule_notifications(engine: sqlalchemy.engine.Engine, user_id: int):
     with engine.begin() as conn:
         job_id_query = conn.execute(sqlalchemy.text(
@@ -865,22 +866,24 @@ def db_cancel_schedule_notifications(engine: sqlalchemy.engine.Engine, user_id:
 
 def cancel_schedule_notifications(query: CallbackQuery, context: CallbackContext):
     try:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.DB_WRITE,
             db_cancel_schedule_notifications,
             engine,
-            query.from_user.id,
-            update=query
+            query.from_user.id
         )
         global settings_state_dict
         settings_state_dict[query.from_user.id].schedule = cns.DISABLED_SCHEDULE_NOTIFICATION
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': 'Больше не присылаю уведомлений о расписании'},
             {'reply_markup': settings_markup(
-                get_user_notify_mode(query.from_user.id))},
-            update=query
+                get_user_notify_mode(query.from_user.id))}
         )
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error(str(e), exc_info=True)
 
@@ -905,23 +908,25 @@ def db_cancel_news_notifications(engine: sqlalchemy.engine.Engine, user_id: int)
 
 def cancel_news_notifications(query: CallbackQuery, context: CallbackContext):
     try:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.DB_WRITE,
             db_cancel_news_notifications,
             engine,
-            query.from_user.id,
-            update=query
+            query.from_user.id
         )
         global settings_state_dict
         settings_state_dict[query.from_user.id].news = cns.DISABLED_NEWS_NOTIFICATION
 
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': 'Больше не присылаю уведомлений о новостях'},
             {'reply_markup': settings_markup(
-                get_user_notify_mode(query.from_user.id))},
-            update=query
+                get_user_notify_mode(query.from_user.id))}
         )
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error(str(e), exc_info=True)
 
@@ -941,23 +946,20 @@ def button(update: Update, context: CallbackContext):
             msg_to_user = 'Сейчас ' + \
                 str(current_week) + \
                 ' неделя.\nЗанятий на этой неделе больше не будет\n\n'
-            next_week_with_classes = current_week
-            while not current_user_timetable and next_week_with_classes <= 18:
-                next_week_with_classes += 1
-                current_user_timetable = get_user_week_timetable(
-                    query.from_user.id, next_week_with_classes, is_rest_week=False)
-            if next_week_with_classes <= 18:
+            next_week_with_classes, current_user_timetable = get_user_next_week_timetable(
+                query.from_user.id, current_week)
+            if next_week_with_classes is not None:
                 msg_to_user += 'Занятия на ' + \
                     str(next_week_with_classes) + ' неделю:\n'
                 for msg in current_user_timetable:
                     msg_to_user += msg + "\n\n"
 
-            context.dispatcher.run_async(
+            pools.submit(
+                pools.TELEGRAM_IO,
                 edit_message_text_and_markup_async,
                 query,
                 {'text': msg_to_user},
-                {'reply_markup': timetable_markup(chosen_time)},
-                update=update
+                {'reply_markup': timetable_markup(chosen_time)}
             )
         else:
             msg_to_user = 'Сейчас ' + \
@@ -966,30 +968,30 @@ def button(update: Update, context: CallbackContext):
             for msg in current_user_timetable:
                 msg_to_user += msg + "\n\n"
 
-            context.dispatcher.run_async(
+            pools.submit(
+                pools.TELEGRAM_IO,
                 edit_message_text_and_markup_async,
                 query,
                 {'text': msg_to_user},
-                {'reply_markup': timetable_markup(chosen_time)},
-                update=update
+                {'reply_markup': timetable_markup(chosen_time)}
             )
     elif chosen_time == cns.DAY_SCHEDULE:
         current_user_timetable = get_user_day_timetable(query.from_user.id)
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': f"Сейчас {current_week} неделя\n\n" +
                 current_user_timetable if current_user_timetable is not None else cns.USER_FREE_DAY},
-            {'reply_markup': timetable_markup(chosen_time)},
-            update=update
+            {'reply_markup': timetable_markup(chosen_time)}
         )
     elif chosen_time == cns.SPECIFIC_WEEK_SCHEDULE:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': f"Сейчас {current_week} неделя\n\nВыберите номер недели:"},
-            {'reply_markup': weeks_num_markup()},
-            update=query
+            {'reply_markup': weeks_num_markup()}
         )
         return cns.SPECIFIC_WEEK_SCHEDULE_HANDLER
     return cns.SCHEDULE_MENU_HANDLER
@@ -999,23 +1001,23 @@ def settings_controller(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     if query.data == cns.DISABLED_SCHEDULE_NOTIFICATION:     # SEND AT SPECIFIC TIME
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': "Ну выбери ты уже пункт меню\n"},
-            {'reply_markup': schedule_notification_settings_markup()},
-            update=update
+            {'reply_markup': schedule_notification_settings_markup()}
         )
         return cns.SETTINGS_CONTROLLER_HANDLER
     elif query.data == cns.ENABLED_SCHEDULE_NOTIFICATION:    # DON'T SEND NOTIFICATIONS TO USER
         return cancel_schedule_notifications(query, context)
     elif query.data == cns.DISABLED_NEWS_NOTIFICATION:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': "Ну выбери ты уже пункт меню\n"},
-            {'reply_markup': news_notification_settings_markup()},
-            update=update
+            {'reply_markup': news_notification_settings_markup()}
         )
         return cns.SETTINGS_CONTROLLER_HANDLER
         # return send_user_request_of_specific_time(query, context)
@@ -1035,13 +1037,13 @@ def subscribe_user_to_immediate_news(query: CallbackQuery, context: CallbackCont
         )
     global settings_state_dict
     settings_state_dict[query.from_user.id].news = cns.ENABLED_NEWS_NOTIFICATION
-    context.dispatcher.run_async(
+    pools.submit(
+        pools.TELEGRAM_IO,
         edit_message_text_and_markup_async,
         query,
         {'text': 'Вы будете получать уведомления о новостях'},
         {'reply_markup': settings_markup(
-            get_user_notify_mode(query.from_user.id))},
-        update=query
+            get_user_notify_mode(query.from_user.id))}
     )
     return cns.START_SETTINGS_HANDLER
 
@@ -1056,37 +1058,38 @@ def norification_settings_controller(update: Update, context: CallbackContext) -
     elif query.data == cns.SEND_NEWS_IMMEDIATELY:
         return subscribe_user_to_immediate_news(query, context)
     elif query.data == cns.BACK_TO_SETTINGS:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': "Настройки подписок"},
             {'reply_markup': settings_markup(
-                get_user_notify_mode(query.from_user.id))},
-            update=update
+                get_user_notify_mode(query.from_user.id))}
         )
         return cns.START_SETTINGS_HANDLER
     elif query.data == cns.BACK_TO_SCHEDULE_SETTINGS:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': "Ну выбери ты уже пункт меню\n"},
-            {'reply_markup': schedule_notification_settings_markup()},
-            update=update
+            {'reply_markup': schedule_notification_settings_markup()}
         )
         return cns.SETTINGS_CONTROLLER_HANDLER
     elif query.data == cns.BACK_TO_NEWS_SETTINGS:
-        context.dispatcher.run_async(
+        pools.submit(
+            pools.TELEGRAM_IO,
             edit_message_text_and_markup_async,
             query,
             {'text': "Ну выбери ты уже пункт меню\n"},
-            {'reply_markup': news_notification_settings_markup()},
-            update=update
+            {'reply_markup': news_notification_settings_markup()}
         )
         return cns.SETTINGS_CONTROLLER_HANDLER
 
 
 def send_user_request_of_specific_time(query: CallbackQuery, context: CallbackContext) -> str:
-    context.dispatcher.run_async(
+    pools.submit(
+        pools.TELEGRAM_IO,
         edit_message_text_and_markup_async,
         query,
         {'text': 'Введите желаемое время\nФормат: hh:mm'},
@@ -1102,8 +1105,7 @@ def send_user_request_of_specific_time(query: CallbackQuery, context: CallbackCo
                     )]
                 ]
             )
-        },
-        update=query
+        }
     )
 
     return cns.SCHEDULE_SPECIFIC_TIME_SETTINGS_HANDLER \
@@ -1112,7 +1114,8 @@ def send_user_request_of_specific_time(query: CallbackQuery, context: CallbackCo
 
 
 def send_user_request_of_offset_time(query: CallbackQuery, context: CallbackContext) -> str:
-    context.dispatcher.run_async(
+    pools.submit(
+        pools.TELEGRAM_IO,
         edit_message_text_and_markup_async,
         query,
         {'text': 'Введите offset времени перед парами\nФормат: hh:mm'},
@@ -1121,14 +1124,15 @@ def send_user_request_of_offset_time(query: CallbackQuery, context: CallbackCont
                 [[InlineKeyboardButton(
                     "Назад", callback_data=cns.BACK_TO_SCHEDULE_SETTINGS)]]
             )
-        },
-        update=query
+        }
     )
 
     return cns.OFFSET_TIME_SETTINGS_HANDLER
 
 
 def fallback(update: Update, context: CallbackContext):
+    # The same update_id comes back, it must not be taken for a redelivery
+    recent_update_ids.mark_requeued(update.update_id)
     context.update_queue.put(update)
     return ConversationHandler.END
 
@@ -1146,28 +1150,30 @@ def proceed_specific_week_schedule(update: Update, context: CallbackContext) ->
             current_user_timetable = get_user_week_timetable(
                 query.from_user.id, chosen_week, is_rest_week=False)
             if not current_user_timetable:
-                context.dispatcher.run_async(
+                pools.submit(
+                    pools.TELEGRAM_IO,
                     edit_message_text_and_markup_async,
                     query,
                     {'text': f'Занятий на {chosen_week} неделе не будет'},
                     {'reply_markup': InlineKeyboardMarkup(
-                        [[InlineKeyboardButton("Назад", callback_data=cns.DAY_SCHEDULE)]])},
-                    update=update
+                        [[InlineKeyboardButton("Назад", callback_data=cns.DAY_SCHEDULE)]])}
                 )
             else:
                 msg_to_user = (
                     cns.CREDIT_WEEK + '\n\n') if chosen_week == 18 else f'{chosen_week} неделя\n\n'
                 for msg in current_user_timetable:
                     msg_to_user += msg + "\n\n"
-                context.dispatcher.run_async(
+                pools.submit(
+                    pools.TELEGRAM_IO,
                     edit_message_text_and_markup_async,
                     query,
                     {'text': msg_to_user},
                     {'reply_markup': InlineKeyboardMarkup(
-                        [[InlineKeyboardButton("Назад", callback_data=cns.DAY_SCHEDULE)]])},
-                    update=update
+                        [[InlineKeyboardButton("Назад", callback_data=cns.DAY_SCHEDULE)]])}
                 )
         return cns.SCHEDULE_MENU_HANDLER
+    except pools.PoolOverloaded:
+        raise
     except Exception as e:
         logger.error(str(e), exc_info=True)
 
@@ -1177,16 +1183,229 @@ def proceed_map(update: Update, context: CallbackContext):
         update.message.reply_photo(photo=f, parse_mode='HTML')
 
 
-def remove_html_tags(data: str) -> str:
-    p = re.compile(r'<img.*?/>|<br />')
-    return p.sub('', data)
+def load_room_occupancy(_key) -> RoomOccupancy:
+    with engine.connect() as conn:
+        rooms_query = conn.execute(sqlalchemy.text(
+            "SELECT room, occupancy FROM test.room_occupancy"))
+        occupancy = {
+            row['room']: occupancy_from_bytes(bytes(row['occupancy']))
+            for row in rooms_query
+        }
+        pairs_query = conn.execute(sqlalchemy.text(
+            "SELECT pair_number, min(starttime) AS starttime, max(endtime) AS endtime "
+            f"FROM {cns.TIMETABLE_WEEK_VIEW_NAME} "
+            "WHERE pair_number IS NOT NULL "
+            "GROUP BY pair_number "
+            "ORDER BY pair_number"))
+        pair_times = [
+            (row['pair_number'], row['starttime'], row['endtime'])
+            for row in pairs_query
+        ]
+    return RoomOccupancy(occupancy, pair_times)
+
+
+def proceed_free_rooms(update: Update, context: CallbackContext):
+    occupancy = room_occupancy_cache.get_or_load('room_occupancy', load_room_occupancy)
+    # /rooms [корпус|*] [номер пары]
+    building = context.args[0] if context.args and context.args[0] != '*' else None
+    now = get_local_now()
+    if len(context.args) > 1 and context.args[1].isdigit():
+        pair = int(context.args[1])
+    else:
+        pair = occupancy.get_pair_at(now.strftime('%H:%M'))
+    if pair is None:
+        update.message.reply_text(text='Пары на сегодня закончились')
+        return
+    free_rooms = occupancy.free_rooms(
+        get_study_week(now.date()), now.isoweekday(), pair, building)
+    text = (
+        f"Свободные аудитории{' в корпусе ' + building if building else ''}, {pair} пара:\n"
+        + (', '.join(free_rooms) if free_rooms else 'нет')
+    )
+    update.message.reply_text(text=text[:cns.MAX_MESSAGE_LENGTH])
+
+
+def proceed_calendar(update: Update, context: CallbackContext):
+    user_group = get_user_group(update.message.from_user.id)
+    if user_group is None or user_group.is_teacher:
+        update.message.reply_text(text='Календарь есть только для групп')
+        return
+    with engine.connect() as conn:
+        calendar = conn.execute(sqlalchemy.text(
+            "SELECT file_id, content_hash FROM test.group_ics WHERE group_name = :gn"),
+            gn=user_group.name
+        ).fetchone()
+        if calendar is None:
+            update.message.reply_text(text='Календарь для вашей группы еще не готов')
+            return
+        if calendar['file_id'] is not None:
+            update.message.reply_document(document=calendar['file_id'])
+            metrics.inc('calendar_sent_by_file_id')
+            return
+        content = conn.execute(sqlalchemy.text(
+            "SELECT content FROM test.group_ics WHERE group_name = :gn"),
+            gn=user_group.name
+        ).scalar()
+    message = update.message.reply_document(
+        document=io.BytesIO(content.encode()),
+        filename=f'{user_group.name}.ics'
+    )
+    metrics.inc('calendar_uploaded')
+    with engine.begin() as conn:
+        # calendar may have been regenerated while we were uploading
+        conn.execute(sqlalchemy.text(
+            "UPDATE test.group_ics SET file_id = :fid "
+            "WHERE group_name = :gn AND content_hash = :hash"),
+            fid=message.document.file_id,
+            gn=user_group.name,
+            hash=calendar['content_hash']
+        )
+
+
+def get_user_pair_index(update: Update):
+    user_group = get_user_group(update.message.from_user.id)
+    if user_group is None:
+        update.message.reply_text(text='Сначала выберите группу')
+        return None
+    return get_pair_index(user_group.name, user_group.is_teacher)
+
+
+def proceed_now(update: Update, context: CallbackContext):
+    pair_index = get_user_pair_index(update)
+    if pair_index is None:
+        return
+    now = get_local_now()
+    texts = pair_index.current(get_study_week(now.date()), now.isoweekday(), now.strftime('%H:%M'))
+    text = 'Сейчас:\n' + ''.join(texts) if texts else cns.NO_CURRENT_PAIR
+    update.message.reply_text(text=text[:cns.MAX_MESSAGE_LENGTH])
+
+
+def proceed_next(update: Update, context: CallbackContext):
+    pair_index = get_user_pair_index(update)
+    if pair_index is None:
+        return
+    now = get_local_now()
+    next_pair = pair_index.next(get_study_week(now.date()), now.isoweekday(), now.strftime('%H:%M'))
+    if next_pair is None:
+        update.message.reply_text(text=cns.NO_NEXT_PAIR)
+        return
+    week, day, texts = next_pair
+    text = get_days_by_week(week)[day - 1] + '\n' + ''.join(texts)
+    update.message.reply_text(text=text[:cns.MAX_MESSAGE_LENGTH])
+
+
+def proceed_last_semester(update: Update, context: CallbackContext):
+    # /last_semester [неделя], the first week by default
+    user_group = get_user_group(update.message.from_user.id)
+    if user_group is None or user_group.is_teacher:
+        update.message.reply_text(text='Прошлый семестр есть только для групп')
+        return
+    week = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    semester = get_previous_semester(get_semester(datetime.date.today()))
+    week_timetable = get_semester_week_timetable(user_group.name, semester, week)
+    if not week_timetable:
+        update.message.reply_text(text=cns.NO_HISTORY)
+        return
+    text = f'{week} неделя прошлого семестра\n\n' + '\n\n'.join(week_timetable)
+    update.message.reply_text(text=text[:cns.MAX_MESSAGE_LENGTH])
+
+
+def proceed_profile(update: Update, context: CallbackContext):
+    # /profile cpu|memory, the second call writes the profile
+    action = context.args[0] if context.args else None
+    if action == 'cpu':
+        path = profiling.toggle_sampling_profiler()
+    elif action == 'memory':
+        path = profiling.toggle_tracemalloc()
+    else:
+        update.message.reply_text(text='/profile cpu|memory')
+        return
+    update.message.reply_text(text=f'Записано в {path}' if path else 'Запущено')
+
+
+def on_user_changed(payload):
+    user_group_cache.invalidate(int(payload) if payload else None)
+
+
+def on_timetable_reloaded(_payload):
+    prerendered_cache.invalidate()
+    teacher_names_cache.invalidate()
+    room_occupancy_cache.invalidate()
+    pair_index_cache.invalidate()
+    invalidate_timetable_snapshot()
+
+
+def on_news_inserted(_payload):
+    news_cache.invalidate()
+
+
+def drop_duplicate_update(update: Update, context: CallbackContext):
+    # Runs before every other handler, see main
+    if recent_update_ids.check_and_add(update.update_id):
+        logger.info(f'dropped redelivered update {update.update_id}')
+        raise DispatcherHandlerStop()
+
+
+# Handler classes of RATE_LIMITS in config, by what the update asks for
+TIMETABLE_CALLBACKS = {cns.DAY_SCHEDULE, cns.WEEK_SCHEDULE}
+NEWS_CALLBACKS = {cns.DAY_NEWS, cns.LAST_FIVE_NEWS}
+TIMETABLE_COMMANDS = {'/rooms', '/calendar', '/last_semester', '/now', '/next'}
+
+
+def get_handler_class(update: Update) -> str:
+    if update.callback_query is not None:
+        data = update.callback_query.data or ''
+        if data in TIMETABLE_CALLBACKS or data.startswith('WEEK'):
+            return 'timetable'
+        if data in NEWS_CALLBACKS or data.startswith(
+                (cns.NEWS_SEARCH_PAGE_PREFIX, cns.OLDER_NEWS_PREFIX)):
+            return 'news'
+    elif update.message is not None and update.message.text:
+        text = update.message.text
+        if text == cns.SCHEDULE_BUTTON_TEXT or text.split(maxsplit=1)[0] in TIMETABLE_COMMANDS:
+            return 'timetable'
+        if text == cns.NEWS_BUTTON_TEXT or text.startswith('/search'):
+            return 'news'
+    return 'default'
+
+
+def throttle_update(update: Update, context: CallbackContext):
+    # Runs after drop_duplicate_update and before the handlers, see main
+    if recent_update_ids.take_requeued(update.update_id):
+        # the user was charged for it on the first dispatch
+        return
+    user = update.effective_user
+    if user is None or rate_limit.allow(get_handler_class(update), user.id):
+        return
+    if update.callback_query is not None:
+        # stops the spinner on the button, nothing is read from the database
+        try:
+            pools.submit(pools.TELEGRAM_IO, update.callback_query.answer, text=cns.THROTTLED)
+        except pools.PoolOverloaded:
+            pass
+    raise DispatcherHandlerStop()
+
+
+def proceed_stats(update: Update, context: CallbackContext):
+    update.message.reply_text(
+        text=metrics.format_stats()[:cns.MAX_MESSAGE_LENGTH] or 'Пусто')
 
 
 def my_error_handler(update: Update, context: CallbackContext):
     """Log Errors caused by Updates."""
     try:
         raise context.error
-    except (ValueError, KeyError):
+    except pools.PoolOverloaded as e:
+        # Shed the update with a cheap reply instead of queueing it
+        metrics.inc('busy_replies')
+        logger.warning(str(e))
+        if update is not None and update.effective_chat is not None:
+            context.bot.queue_message(update.effective_chat.id, cns.BOT_BUSY)
+    except (ValueError, KeyError) as e:
+        if update is None or update.message is None:
+            # failed work of a worker pool, see pools.set_error_handler
+            logger.warning('Update "%s" caused error "%s"', update, e, exc_info=True)
+            return
         if update.message.text in cns.PLAIN_MENU_BUTTONS:
             fallback(update, context)
             return ConversationHandler.END
@@ -1197,10 +1416,18 @@ def my_error_handler(update: Update, context: CallbackContext):
 
 
 def main():
+    log.setup_logging()
+    # before handler threads start, setlocale is not thread-safe
+    set_ru_locale()
 
     my_persistence = PicklePersistence(filename='persist.backup')
-    updater = Updater(config.bot_token,
-                      persistence=my_persistence, use_context=True)
+    # All replies and edits go through the delivery queue, so handlers
+    # share rate limits with everything else we send
+    bot = DeliveryBot(
+        config.bot_token,
+        request=Request(con_pool_size=config.DELIVERY_WORKERS + 8)
+    )
+    updater = Updater(bot=bot, persistence=my_persistence, use_context=True)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -1230,7 +1457,9 @@ def main():
         states={
             cns.CLAIM_USER_GROUP_HANDLER: [MessageHandler(Filters.text & (~Filters.command), init_user)],
             cns.SET_USER_GROUP_HANDLER: [CallbackQueryHandler(
-                select_group, pattern=r'^.*(-(\d*)|-.*(\d[а-яА-Я])|(ИДО)|(Аспиранты)|(ФДО)|(ЦМО)|(ИСР)|(группа))$')]
+                select_group,
+                pattern=fr'^({cns.TEACHER_CALLBACK_PREFIX}[0-9a-f]{{16}}|'
+                        r'.*(-(\d*)|-.*(\d[а-яА-Я])|(ИДО)|(Аспиранты)|(ФДО)|(ЦМО)|(ИСР)|(группа)))$')]
         },
 
         allow_reentry=False,
@@ -1324,12 +1553,55 @@ def main():
     map_handler = MessageHandler(Filters.text(
         cns.MAP_BUTTON_TEXT) & (~Filters.command), proceed_map)
 
+    news_search_handlers = [
+        CommandHandler('search', proceed_news_search),
+        CallbackQueryHandler(
+            news_search_page,
+            pattern=fr'^{cns.NEWS_SEARCH_PAGE_PREFIX}\d+$'
+        ),
+        CallbackQueryHandler(
+            older_news_page,
+            pattern=fr'^{cns.OLDER_NEWS_PREFIX}-?\d+:\d+$'
+        )
+    ]
+
+    free_rooms_handler = CommandHandler('rooms', proceed_free_rooms)
+
+    calendar_handler = CommandHandler('calendar', proceed_calendar)
+
+    last_semester_handler = CommandHandler('last_semester', proceed_last_semester)
+
+    now_handler = CommandHandler('now', proceed_now)
+
+    next_handler = CommandHandler('next', proceed_next)
+
+    stats_handler = CommandHandler(
+        'stats', proceed_stats, filters=Filters.user(user_id=config.ADMIN_IDS))
+
+    profile_handler = CommandHandler(
+        'profile', proceed_profile, filters=Filters.user(user_id=config.ADMIN_IDS))
+
+    dp.add_handler(TypeHandler(Update, drop_duplicate_update), group=-2)
+    dp.add_handler(TypeHandler(Update, throttle_update), group=-1)
+    # Before conversations, some of their states take any callback query
+    for handler in news_search_handlers:
+        dp.add_handler(handler)
     dp.add_handler(schedule_conv_handler)
     dp.add_handler(settings_conversation_handler)
     dp.add_handler(news_conv_handler)
     dp.add_handler(change_group_conv_handler)
     dp.add_handler(map_handler)
-    dp.add_error_handler(my_error_handler)
+    dp.add_handler(free_rooms_handler)
+    dp.add_handler(calendar_handler)
+    dp.add_handler(last_semester_handler)
+    dp.add_handler(now_handler)
+    dp.add_handler(next_handler)
+    dp.add_handler(stats_handler)
+    dp.add_handler(profile_handler)
+    log.instrument_handlers(dp.handlers[0])
+    dp.add_error_handler(log.instrument(my_error_handler))
+    # failures of the work handlers submit to the worker pools go there too
+    pools.set_error_handler(dp.dispatch_error)
     # Start the Bot
     # updater.start_polling()
     # updater.start_webhook(
@@ -1352,6 +1624,24 @@ def main():
                     f'{config.WEBHOOK_PORT}/{config.bot_token}'
     )
 
+    profiling.install_signal_handlers()
+
+    # Writers in other processes tell us what to drop from the caches,
+    # senders what to deliver for them. A reconnect drains the outbox too.
+    NotifyListener({
+        USER_CHANGED: on_user_changed,
+        TIMETABLE_RELOADED: on_timetable_reloaded,
+        NEWS_INSERTED: on_news_inserted,
+        DELIVERY_QUEUED: lambda _payload: drain_outbox(bot)
+    }).start()
+    try:
+        drain_outbox(bot)
+    except Exception as e:
+        logger.error(f'delivery outbox: {e}', exc_info=True)
+
+    # Caches are filled shortly before first pairs and timetable messages
+    PrewarmScheduler(updater.job_queue).start()
+
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
@@ -0,0 +1,127 @@
+import datetime
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import requests
+import sqlalchemy
+from app.get_user_token import get_user_token
+import misc.constants as cns
+from misc.config import nstu_login, nstu_password
+from misc.db import get_engine
+from misc.news import fill_news_display_html, fill_news_search_vectors
+from misc.notify import NEWS_INSERTED, notify
+
+# python backfill_news.py FIRST_DAY LAST_DAY [WORKERS], days as YYYY-MM-DD.
+# Loads news of the days that are not in test.news_backfill_day yet,
+# so an interrupted run just continues where it stopped.
+logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+logger = getLogger('backfill_news')
+engine = get_engine()
+
+
+def get_days_to_load(first_day: datetime.date, last_day: datetime.date) -> list:
+    with engine.connect() as conn:
+        loaded_days = {
+            row['day'] for row in conn.execute(
+                sqlalchemy.text(
+                    'SELECT day FROM test.news_backfill_day '
+                    'WHERE day BETWEEN :first_day AND :last_day'
+                ),
+                first_day=first_day,
+                last_day=last_day
+            )
+        }
+    return [
+        first_day + datetime.timedelta(days=i)
+        for i in range((last_day - first_day).days + 1)
+        if first_day + datetime.timedelta(days=i) not in loaded_days
+    ]
+
+
+def fetch_day(session: requests.Session, day: datetime.date):
+    try:
+        response = session.get(
+            cns.NEWS_API_URL + day.strftime('%Y/%m/%d'),
+            timeout=cns.NEWS_BACKFILL_REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        return day, response.text
+    except requests.RequestException as e:
+        # not checkpointed, the next run tries again
+        logger.error(f'news of {day}: {e}')
+        return day, None
+
+
+def load_days(fetched_days: list) -> int:
+    with engine.begin() as conn:
+        # test.json_news is shared with the daily update_news.py
+        conn.execute(sqlalchemy.text('LOCK TABLE test.json_news'))
+        conn.execute(sqlalchemy.text('DELETE FROM test.json_news'))
+        conn.execute(
+            sqlalchemy.text('INSERT INTO test.json_news (data) VALUES (:vl)'),
+            [{'vl': data} for _day, data in fetched_days]
+        )
+        inserted_count = conn.execute(sqlalchemy.text(
+            '''
+            INSERT INTO test.news
+                SELECT * FROM test.fill_news_view
+                ON CONFLICT (id) DO NOTHING
+            '''
+        )).rowcount
+        fill_news_search_vectors(conn)
+        fill_news_display_html(conn)
+        conn.execute(
+            sqlalchemy.text(
+                'INSERT INTO test.news_backfill_day (day) VALUES (:day) ON CONFLICT DO NOTHING'),
+            [{'day': day} for day, _data in fetched_days]
+        )
+        if inserted_count > 0:
+            notify(conn, NEWS_INSERTED, inserted_count)
+    return inserted_count
+
+
+def backfill(first_day: datetime.date, last_day: datetime.date, workers: int):
+    try:
+        days = get_days_to_load(first_day, last_day)
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        with engine.begin() as conn:
+            file = open('../misc/sql/create/news_backfill_day.sql')
+            conn.execute(sqlalchemy.text(file.read()))
+        days = get_days_to_load(first_day, last_day)
+    logger.info(f'{len(days)} days to load')
+
+    # One authenticated session, its connection pool sized to the workers
+    session = requests.Session()
+    session.cookies.set('NstuSsoToken', get_user_token(nstu_login, nstu_password))
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+    start_time = time.monotonic()
+    loaded_count = 0
+    news_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(days), cns.NEWS_BACKFILL_BATCH_DAYS):
+            batch = days[i:i + cns.NEWS_BACKFILL_BATCH_DAYS]
+            fetched_days = [
+                (day, data)
+                for day, data in executor.map(lambda day: fetch_day(session, day), batch)
+                if data is not None
+            ]
+            if fetched_days:
+                news_count += load_days(fetched_days)
+            loaded_count += len(fetched_days)
+            elapsed = time.monotonic() - start_time
+            logger.info(
+                f'{loaded_count}/{len(days)} days, {news_count} news, '
+                f'{loaded_count / elapsed:.1f} days/s')
+    logger.info(f'done, {len(days) - loaded_count} days failed')
+
+
+backfill(
+    datetime.date.fromisoformat(sys.argv[1]),
+    datetime.date.fromisoformat(sys.argv[2]),
+    int(sys.argv[3]) if len(sys.argv) > 3 else cns.NEWS_BACKFILL_WORKERS
+)
@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+from logging import getLogger
+
+import sqlalchemy
+
+from misc.db import get_engine
+from misc.news import fill_news_display_html
+
+# Applies ../misc/sql/migrate/*.sql not applied yet in name order, each in its
+# own transaction. With --list only prints them.
+logger = getLogger('migrate')
+engine = get_engine()
+
+MIGRATIONS_DIR = '../misc/sql/migrate'
+
+# migration -> function(conn) run after it in the same transaction,
+# for data that is filled by Python code
+AFTER_MIGRATION = {
+    '003_news_display_html.sql': fill_news_display_html
+}
+
+with engine.begin() as conn:
+    file = open('../misc/sql/create/schema_migration.sql')
+    conn.execute(sqlalchemy.text(file.read()))
+    applied = {
+        row['name']
+        for row in conn.execute(sqlalchemy.text('SELECT name FROM test.schema_migration'))
+    }
+
+pending = sorted(
+    name for name in os.listdir(MIGRATIONS_DIR)
+    if name.endswith('.sql') and name not in applied
+)
+if '--list' in sys.argv[1:]:
+    print('\n'.join(pending))
+    sys.exit()
+
+for name in pending:
+    start_time = time.monotonic()
+    with engine.begin() as conn:
+        file = open(os.path.join(MIGRATIONS_DIR, name))
+        conn.execute(sqlalchemy.text(file.read()))
+        if name in AFTER_MIGRATION:
+            AFTER_MIGRATION[name](conn)
+        conn.execute(
+            sqlalchemy.text('INSERT INTO test.schema_migration (name) VALUES (:name)'),
+            name=name
+        )
+    logger.info(f'{name} applied in {time.monotonic() - start_time:.1f} s')
@@ -0,0 +1,28 @@
+import datetime
+import sys
+from logging import getLogger
+
+import sqlalchemy
+
+from misc.db import get_engine
+from misc.prerender import prerender_day_timetables
+from misc.study_calendar import get_local_now
+
+# Run off-peak, e.g. at night from cron: renders tomorrow's day timetables,
+# or those of the date given as YYYY-MM-DD, so morning senders only read them.
+# Tomorrow is taken in config.TIMEZONE, as the bot looks them up
+logger = getLogger('prerender_tt')
+engine = get_engine()
+
+date = datetime.date.fromisoformat(sys.argv[1]) if len(sys.argv) > 1 \
+    else get_local_now().date() + datetime.timedelta(days=1)
+try:
+    with engine.begin() as conn:
+        rendered_count = prerender_day_timetables(conn, date)
+except Exception as e:
+    logger.error(str(e), exc_info=True)
+    with engine.begin() as conn:
+        file = open('../misc/sql/create/tt_prerendered.sql')
+        conn.execute(sqlalchemy.text(file.read()))
+        rendered_count = prerender_day_timetables(conn, date)
+logger.info(f'{rendered_count} timetables for {date} rendered')
@@ -0,0 +1,41 @@
+import json
+import sys
+
+import sqlalchemy
+
+from misc.db import get_engine
+from misc.study_calendar import get_current_week
+from misc.timetable import NEXT_WEEK_WITH_CLASSES_SQL, get_timetable_source
+
+# Prints planning and execution times of the bot's timetable queries:
+#   python time_timetable_queries.py NAME [--teacher] [WEEK]
+# Run it before and after schema changes of the timetable views.
+engine = get_engine()
+
+args = [arg for arg in sys.argv[1:] if arg != '--teacher']
+name = args[0]
+is_teacher = '--teacher' in sys.argv[1:]
+week = int(args[1]) if len(args) > 1 else get_current_week()
+
+timetable, name_column, _ = get_timetable_source(is_teacher)
+queries = {
+    'week': f'SELECT * FROM {timetable} WHERE {name_column} = :gn AND week = :week '
+            'ORDER BY day, starttime',
+    'day': f'SELECT * FROM {timetable} WHERE {name_column} = :gn AND week = :week '
+           'AND day = 1 ORDER BY day, starttime',
+    'next_week': NEXT_WEEK_WITH_CLASSES_SQL.format(timetable=timetable, name_column=name_column)
+}
+
+with engine.connect() as conn:
+    for query_name, query in queries.items():
+        plan = conn.execute(
+            sqlalchemy.text(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}'),
+            gn=name,
+            week=week
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]
+        print(f"{query_name}: planning {plan['Planning Time']:.2f} ms, "
+              f"execution {plan['Execution Time']:.2f} ms, "
+              f"{plan['Plan']['Node Type']}")
@@ -2,12 +2,15 @@ import datetime
 
 import requests
 import sqlalchemy
-from telegram import Bot
 from logging import getLogger
 from app.get_user_token import get_user_token
-from misc.config import (bot_token, db_connection_string, nstu_login,
-                         nstu_password)
-from app.run import get_news_from_db
+from misc.config import nstu_login, nstu_password
+from misc.constants import NEWS_API_URL
+from misc.db import get_engine
+from misc.news import (fill_news_display_html, fill_news_search_vectors,
+                       get_news_from_db)
+from misc.notify import NEWS_INSERTED, notify
+from misc.outbox import BULK, enqueue_messages
 
 logger = getLogger('update_news')
 
@@ -22,22 +25,19 @@ def send_new_news(news_count):
             '''
             )
         )
-        bot = Bot(bot_token)
         news = get_news_from_db(news_count)
-        for row in rows:
-            bot.send_message(
-                row['user_id'],
-                news,
-                parse_mode='HTML',
-                disable_web_page_preview=True
-            )
+        queued_count = enqueue_messages(conn, BULK, [
+            (row['user_id'], news, {'parse_mode': 'HTML', 'disable_web_page_preview': True})
+            for row in rows
+        ])
+    logger.info(f'news queued for {queued_count} users')
 
 
 current_date = datetime.date.today().strftime('%Y/%m/%d')
 
-engine = sqlalchemy.create_engine(db_connection_string)
+engine = get_engine()
 jsonnews = requests.get(
-    url='https://api.ciu.nstu.ru/v1.0/news/schoolkids/' + current_date,
+    url=NEWS_API_URL + current_date,
     cookies={'NstuSsoToken': get_user_token(nstu_login, nstu_password)}
 )
 try:
@@ -53,6 +53,11 @@ try:
             ),
             vl=jsonnews.text
         )
+        fill_news_search_vectors(conn)
+        fill_news_display_html(conn)
+        # the bot's news cache is only dropped when there is something new
+        if rows_count.rowcount > 0:
+            notify(conn, NEWS_INSERTED, rows_count.rowcount)
     if rows_count.rowcount > 0:
         send_new_news(rows_count.rowcount)
 except Exception as e:
@@ -60,7 +65,7 @@ except Exception as e:
     with engine.begin() as conn:
         file = open('../misc/sql/create/news.sql')
         conn.execute(sqlalchemy.text(file.read()))
-        conn.execute(sqlalchemy.text(
+        rows_count = conn.execute(sqlalchemy.text(
             '''
             DELETE FROM test.json_news;
             INSERT INTO test.json_news (data) VALUES (:vl);
@@ -71,5 +76,9 @@ except Exception as e:
             '''),
             vl=jsonnews.text
         )
+        fill_news_search_vectors(conn)
+        fill_news_display_html(conn)
+        if rows_count.rowcount > 0:
+            notify(conn, NEWS_INSERTED, rows_count.rowcount)
 
 logger.info(f'done {str(rows_count.rowcount)} news')
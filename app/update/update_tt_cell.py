@@ -1,12 +1,277 @@
+import datetime
+from itertools import groupby
 from logging import getLogger
 
 import misc.config as config
+import misc.constants as cns
 import requests
 import sqlalchemy
 from app.get_user_token import get_user_token
+from misc.ics import build_group_calendar, get_content_hash
+from misc.notify import TIMETABLE_RELOADED, notify
+from misc.outbox import BULK, enqueue_messages
+from misc.prerender import prerender_day_timetables
+from misc.study_calendar import (get_current_week, get_days_by_week,
+                                 get_first_study_day_date, get_semester)
+from misc.timetable import TIMETABLE_ROW_TEMPLATE, get_timetable_name
+from misc.tt_snapshot import write_snapshot
+from misc.room_occupancy import (build_room_occupancy, get_building,
+                                 occupancy_to_bytes)
 
 logger = getLogger('update_tt_cell')
 engine = sqlalchemy.create_engine(config.db_connection_string)
+
+
+DAY_FINGERPRINTS_SQL = open('../misc/sql/select/tt_day_fingerprints.sql').read() \
+    .format(timetable=cns.TIMETABLE_WEEK_VIEW_NAME)
+
+# In dependency order
+TIMETABLE_VIEWS = [
+    (cns.TIMETABLE_WEEK_VIEW_NAME, '../misc/sql/create/tt_group_week.sql'),
+    (cns.TEACHER_TIMETABLE_WEEK_VIEW_NAME, '../misc/sql/create/tt_teacher_week.sql')
+]
+
+
+def refresh_timetable_views():
+    for view_name, create_file in TIMETABLE_VIEWS:
+        try:
+            # CONCURRENTLY lets the bot keep reading the old rows while we refresh
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(sqlalchemy.text(
+                    f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view_name}'
+                ))
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            with engine.begin() as conn:
+                file = open(create_file)
+                conn.execute(sqlalchemy.text(file.read()))
+
+
+def write_timetable_history(conn):
+    # Replaces the current semester's partition, past ones are kept
+    semester = get_semester(datetime.date.today())
+    partition = get_timetable_name(semester)
+    conn.execute(sqlalchemy.text(
+        f"CREATE TABLE IF NOT EXISTS {partition} "
+        f"PARTITION OF {cns.TIMETABLE_NAME} FOR VALUES IN ('{semester}')"
+    ))
+    conn.execute(sqlalchemy.text(f'DELETE FROM {partition}'))
+    return conn.execute(
+        sqlalchemy.text(
+            f'INSERT INTO {partition} SELECT :semester, * FROM {cns.TIMETABLE_WEEK_VIEW_NAME}'
+        ),
+        semester=semester
+    ).rowcount
+
+
+def rebuild_timetable_history():
+    try:
+        with engine.begin() as conn:
+            rows_count = write_timetable_history(conn)
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        with engine.begin() as conn:
+            file = open('../misc/sql/create/tt_history.sql')
+            conn.execute(sqlalchemy.text(file.read()))
+            rows_count = write_timetable_history(conn)
+    logger.info(f'{rows_count} timetable rows kept in {get_timetable_name()}')
+
+
+def write_room_occupancy(conn):
+    rows = conn.execute(sqlalchemy.text(
+        f'''
+        SELECT DISTINCT rooms, week, day, pair_number
+        FROM {cns.TIMETABLE_WEEK_VIEW_NAME}
+        WHERE rooms IS NOT NULL
+        '''
+    ))
+    occupancy = build_room_occupancy(rows)
+    conn.execute(sqlalchemy.text('DELETE FROM test.room_occupancy'))
+    if occupancy:
+        conn.execute(
+            sqlalchemy.text(
+                'INSERT INTO test.room_occupancy (room, building, occupancy) '
+                'VALUES (:room, :building, :occupancy)'
+            ),
+            [
+                {
+                    'room': room,
+                    'building': get_building(room),
+                    'occupancy': occupancy_to_bytes(room_occupancy)
+                }
+                for room, room_occupancy in occupancy.items()
+            ]
+        )
+
+
+def rebuild_room_occupancy():
+    try:
+        with engine.begin() as conn:
+            write_room_occupancy(conn)
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        with engine.begin() as conn:
+            file = open('../misc/sql/create/room_occupancy.sql')
+            conn.execute(sqlalchemy.text(file.read()))
+            write_room_occupancy(conn)
+
+
+def read_timetable_rows() -> list:
+    with engine.connect() as conn:
+        return conn.execute(sqlalchemy.text(
+            f'''
+            SELECT *
+            FROM {cns.TIMETABLE_WEEK_VIEW_NAME}
+            ORDER BY group_name, week, day, starttime
+            '''
+        )).fetchall()
+
+
+def write_group_calendars(conn, rows):
+    first_study_day = get_first_study_day_date()
+    calendars = []
+    for group_name, group_rows in groupby(rows, key=lambda row: row['group_name']):
+        content = build_group_calendar(group_name, group_rows, first_study_day)
+        calendars.append({
+            'gn': group_name,
+            'content': content,
+            'content_hash': get_content_hash(content)
+        })
+    if calendars:
+        # Unchanged calendars keep their file_id, so telegram doesn't get them again
+        conn.execute(
+            sqlalchemy.text(
+                '''
+                INSERT INTO test.group_ics (group_name, content, content_hash)
+                VALUES (:gn, :content, :content_hash)
+                ON CONFLICT (group_name) DO UPDATE
+                SET (content, content_hash, file_id, date_add)
+                    = (EXCLUDED.content, EXCLUDED.content_hash, NULL, now())
+                WHERE test.group_ics.content_hash <> EXCLUDED.content_hash
+                '''
+            ),
+            calendars
+        )
+
+
+def rebuild_group_calendars(rows):
+    try:
+        with engine.begin() as conn:
+            write_group_calendars(conn, rows)
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        with engine.begin() as conn:
+            file = open('../misc/sql/create/group_ics.sql')
+            conn.execute(sqlalchemy.text(file.read()))
+            write_group_calendars(conn, rows)
+
+
+def write_timetable_snapshot(rows):
+    # Bot and senders fall back to this file when the database is slow or down
+    groups_count = write_snapshot(
+        config.TIMETABLE_SNAPSHOT_PATH,
+        (
+            (group_name, [
+                (row['week'], row['day'], row['endtime'], TIMETABLE_ROW_TEMPLATE(row))
+                for row in group_rows
+            ])
+            for group_name, group_rows in groupby(rows, key=lambda row: row['group_name'])
+        )
+    )
+    logger.info(f'snapshot of {groups_count} groups written')
+
+
+def rerender_day_timetables():
+    # Texts rendered from the old timetable must not be sent
+    today = datetime.date.today()
+    with engine.begin() as conn:
+        for date in (today, today + datetime.timedelta(days=1)):
+            prerender_day_timetables(conn, date)
+
+
+def save_day_fingerprints(conn, weeks) -> int:
+    conn.execute(sqlalchemy.text('DELETE FROM test.tt_day_fingerprint'))
+    return conn.execute(
+        sqlalchemy.text(f'INSERT INTO test.tt_day_fingerprint {DAY_FINGERPRINTS_SQL}'),
+        weeks=weeks
+    ).rowcount
+
+
+def remember_day_fingerprints(weeks) -> int:
+    # Fingerprints of the timetable that is about to be replaced
+    try:
+        with engine.begin() as conn:
+            return save_day_fingerprints(conn, weeks)
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        with engine.begin() as conn:
+            file = open('../misc/sql/create/tt_day_fingerprint.sql')
+            conn.execute(sqlalchemy.text(file.read()))
+            return save_day_fingerprints(conn, weeks)
+
+
+def read_changed_days(weeks) -> list:
+    with engine.connect() as conn:
+        return conn.execute(
+            sqlalchemy.text(
+                f'''
+                WITH new AS ({DAY_FINGERPRINTS_SQL})
+                SELECT coalesce(new.group_name, old.group_name) AS group_name,
+                       coalesce(new.week, old.week) AS week,
+                       coalesce(new.day, old.day) AS day
+                FROM new
+                FULL JOIN test.tt_day_fingerprint AS old
+                    ON (new.group_name, new.week, new.day)
+                       = (old.group_name, old.week, old.day)
+                WHERE new.fingerprint IS DISTINCT FROM old.fingerprint
+                ORDER BY 1, 2, 3
+                '''
+            ),
+            weeks=weeks
+        ).fetchall()
+
+
+def get_timetable_change_text(group_name, days, rows_by_day) -> str:
+    text = cns.TIMETABLE_CHANGED
+    for week, day in days:
+        rows = rows_by_day.get((group_name, week, day))
+        text += '\n' + get_days_by_week(week)[day - 1] + '\n' \
+            + (''.join(map(TIMETABLE_ROW_TEMPLATE, rows)) if rows else cns.NO_PAIRS)
+    return text[:cns.MAX_MESSAGE_LENGTH]
+
+
+def send_timetable_changes(weeks, rows):
+    changed_days = {}
+    for row in read_changed_days(weeks):
+        changed_days.setdefault(row['group_name'], []).append((row['week'], row['day']))
+    if not changed_days:
+        return
+    rows_by_day = {}
+    for row in rows:
+        if row['group_name'] in changed_days:
+            rows_by_day.setdefault(
+                (row['group_name'], row['week'], row['day']), []).append(row)
+    texts = {}
+    with engine.begin() as conn:
+        users = conn.execute(
+            sqlalchemy.text(
+                'SELECT user_id, group_name FROM users.usergroup '
+                'WHERE NOT is_teacher AND group_name = ANY(:groups)'
+            ),
+            groups=list(changed_days)
+        ).fetchall()
+        for user in users:
+            group_name = user['group_name']
+            if group_name not in texts:
+                texts[group_name] = get_timetable_change_text(
+                    group_name, changed_days[group_name], rows_by_day)
+        queued_count = enqueue_messages(conn, BULK, [
+            (user['user_id'], texts[user['group_name']], {}) for user in users
+        ])
+    logger.info(f'timetable of {len(changed_days)} groups changed, '
+                f'{queued_count} users notified')
+
+
 tt_cell = requests.get(
     url='https://api.ciu.nstu.ru/v1.0/data/simple/tt_cell',
     cookies={'NstuSsoToken': get_user_token(
@@ -46,4 +311,37 @@ except Exception as e:
             ),
             vl=tt_cell.text
         )
+
+# Only this and the next week are compared, older changes are of no use
+changed_weeks = [get_current_week(), get_current_week() + 1]
+try:
+    previous_days_count = remember_day_fingerprints(changed_weeks)
+except Exception as e:
+    logger.error(str(e), exc_info=True)
+    previous_days_count = 0
+refresh_timetable_views()
+try:
+    rebuild_timetable_history()
+except Exception as e:
+    logger.error(str(e), exc_info=True)
+rebuild_room_occupancy()
+try:
+    rerender_day_timetables()
+except Exception as e:
+    logger.error(str(e), exc_info=True)
+timetable_rows = read_timetable_rows()
+# Nothing to compare with on the first run
+if previous_days_count:
+    try:
+        send_timetable_changes(changed_weeks, timetable_rows)
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+rebuild_group_calendars(timetable_rows)
+try:
+    write_timetable_snapshot(timetable_rows)
+except Exception as e:
+    logger.error(str(e), exc_info=True)
+with engine.begin() as conn:
+    # the bot drops caches built from the old timetable
+    notify(conn, TIMETABLE_RELOADED)
 logger.info('done')
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The bot runs from app/ and imports its modules as misc.*, run etc.
+# misc/config.py has to be there, see misc/config_example.py
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'app'))
@@ -0,0 +1,80 @@
+import datetime
+from queue import Queue
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import (ConversationHandler, Dispatcher, Filters,
+                          MessageHandler, TypeHandler)
+
+import run
+from misc.dedup import RecentIds
+
+IN_CONVERSATION = 'IN_CONVERSATION'
+
+
+def make_text_update(update_id: int, text: str) -> Update:
+    return Update(update_id, message=Message(
+        message_id=update_id,
+        date=datetime.datetime.now(),
+        chat=Chat(1, Chat.PRIVATE),
+        from_user=User(1, 'test', False),
+        text=text
+    ))
+
+
+def make_dispatcher(menu_calls: list) -> Dispatcher:
+    # The handler groups of run.main, with one conversation and one menu button
+    dp = Dispatcher(None, Queue(), workers=0, use_context=True)
+    dp.add_handler(TypeHandler(Update, run.drop_duplicate_update), group=-2)
+    dp.add_handler(TypeHandler(Update, run.throttle_update), group=-1)
+    dp.add_handler(ConversationHandler(
+        entry_points=[MessageHandler(Filters.text(['Начать']), lambda u, c: IN_CONVERSATION)],
+        states={IN_CONVERSATION: []},
+        fallbacks=[MessageHandler(Filters.text(['Меню']), run.fallback)]
+    ))
+    dp.add_handler(MessageHandler(
+        Filters.text(['Меню']), lambda u, c: menu_calls.append(u.update_id)))
+    return dp
+
+
+def test_recent_ids_window():
+    recent_ids = RecentIds(2)
+    assert not recent_ids.check_and_add(1)
+    assert recent_ids.check_and_add(1)
+    assert not recent_ids.check_and_add(2)
+    assert not recent_ids.check_and_add(3)
+    # 1 is out of the window
+    assert not recent_ids.check_and_add(1)
+    assert recent_ids.stats() == {'window': 2, 'duplicates': 1}
+
+
+def test_requeued_id_passes_once():
+    recent_ids = RecentIds(10)
+    recent_ids.check_and_add(1)
+    recent_ids.mark_requeued(1)
+    assert not recent_ids.check_and_add(1)
+    # throttle_update takes the mark, the id is a duplicate again
+    assert recent_ids.take_requeued(1)
+    assert not recent_ids.take_requeued(1)
+    assert recent_ids.check_and_add(1)
+
+
+def test_fallback_update_reaches_menu_handler():
+    menu_calls = []
+    dp = make_dispatcher(menu_calls)
+    dp.process_update(make_text_update(1001, 'Начать'))
+    dp.process_update(make_text_update(1002, 'Меню'))
+    # the conversation ended and put the update back to the queue
+    assert menu_calls == []
+    dp.process_update(dp.update_queue.get_nowait())
+    assert menu_calls == [1002]
+    # a redelivery of it afterwards is still dropped
+    dp.process_update(make_text_update(1002, 'Меню'))
+    assert menu_calls == [1002]
+
+
+def test_redelivered_update_is_dropped():
+    menu_calls = []
+    dp = make_dispatcher(menu_calls)
+    dp.process_update(make_text_update(2001, 'Меню'))
+    dp.process_update(make_text_update(2001, 'Меню'))
+    assert menu_calls == [2001]
@@ -0,0 +1,26 @@
+import datetime
+
+from misc.news import NEWS_ROW_TEMPLATE
+
+
+def make_news_row(**values) -> dict:
+    row = {
+        'title': 'Заголовок',
+        'shorttext': None,
+        'url': 'https://www.nstu.ru/news/1',
+        'news_date': datetime.datetime(2020, 9, 1, 10, 0)
+    }
+    row.update(values)
+    return row
+
+
+def test_news_row_template():
+    html = NEWS_ROW_TEMPLATE(make_news_row(shorttext='&lt;b&gt;Текст&lt;/b&gt;'))
+    assert html.startswith('Заголовок\n[Текст]\nhttps://www.nstu.ru/news/1\n')
+    assert html.endswith('\n\n')
+
+
+def test_news_row_template_without_date():
+    # news_date is nullable, such rows must not break the ingestion
+    assert NEWS_ROW_TEMPLATE(make_news_row(news_date=None)) == \
+        'Заголовок\nhttps://www.nstu.ru/news/1\n\n\n'